@@ -24,6 +24,9 @@ import multiprocessing
 import importlib
 import warnings
 import shutil
+import collections
+import queue
+import time
 from tqdm import trange, tqdm
 warnings.filterwarnings("ignore", message="invalid value encountered in true_divide")
 warnings.filterwarnings("ignore", message="invalid value encountered in power")
@@ -35,6 +38,76 @@ warnings.filterwarnings("ignore", message="divide by zero encountered in true_di
 warnings.filterwarnings("ignore", message="Covariance of the parameters could not be estimated")
 os.environ["OMP_NUM_THREADS"] = "1"
 
+# noise power spectrum used by the ps_*chi2 statistics, 'mc' (n_sim_ps noise simulations) or 'analytic'
+# (exact white noise expectation), set from PS_NOISE_MODE in the parameter file. The ps cuts of
+# accept_params are tuned for 'mc', whose std estimate from the simulations is biased: 'analytic' gives
+# lower ps chi2 values (mean ps_chi2 about 5.9 against 6.35 on simulated scans), so retune them before using it.
+ps_noise_mode = 'mc'
+n_sim_ps = 100
+ps_sim_seed = 0  # base seed of the noise simulations, PS_SIM_SEED in the parameter file
+
+# streaming mode of get_scan_stats, the tod is read from the level2 file one feed and block of samples
+# at a time, with blocks sized to use at most about scan_stats_memory_limit MB per worker, set from
+# SCAN_STATS_STREAMING and SCAN_STATS_MEMORY_LIMIT in the parameter file
+scan_stats_streaming = False
+scan_stats_memory_limit = 512
+
+# directory of the scan statistics cache (one file per obsid, see read_stats_cache), SCAN_STATS_CACHE_DIR
+# in the parameter file, None to always recompute. Bump the tag of a statistic in stats_versions when
+# its computation changes, so its cached values are recomputed (statistics not listed have tag '1').
+scan_stats_cache_dir = None
+stats_versions = {}
+
+# directory of the binned map cache (one file per obsid, see write_map_cache), MAP_CACHE_DIR in the
+# parameter file, None for no cache. The float32 maps and rms of all scans, feeds and sidebands of an
+# obsid are kept with its scans, map grid and the get_file_keys of its level2 files, so the ps_stats can
+# be recomputed from them (see get_cached_ps_stats and accept_ps.py) without reading the level2 files.
+# Maps of level2 files that changed since are not used.
+map_cache_dir = None
+ps_stats = ['ps_s_sb_chi2', 'ps_s_feed_chi2', 'ps_s_chi2', 'ps_o_sb_chi2', 'ps_o_feed_chi2', 'ps_o_chi2',
+            'ps_z_s_sb_chi2', 'ps_xy_s_sb_chi2']  # in the order of get_power_spectra
+
+# number of worker processes computing the scan statistics, N_WORKERS in the parameter file (default all
+# available cores). The pool is created once and shared by all fields, see get_pool and close_pool.
+n_workers = None
+pool = None
+pool_size = 0
+task_starts = None  # (worker pid, task id) sent by the workers when they start a task, see run_task
+
+# a scan whose statistics fail (also after scan_retries retries) gets a nan row and its error is kept in
+# scan_errors, per field {scanid: error}, and saved with the scan data. In a parallel run, a scan whose
+# worker dies or that takes longer than scan_timeout seconds (0 for no limit) also counts as a failed
+# attempt, the pool is then recreated (see PoolTasks). Without a statistics cache, completed obsids are written to checkpoint_dir
+# every checkpoint_interval seconds, so a killed run resumes there. Set from SCAN_RETRIES, SCAN_TIMEOUT,
+# CHECKPOINT_DIR and CHECKPOINT_INTERVAL in the parameter file.
+scan_retries = 0
+scan_timeout = 0
+scan_errors = {}
+checkpoint_dir = None
+checkpoint_interval = 600
+
+# layout of the scan and jk data files, OUTPUT_LAYOUT_VERSION in the parameter file. In version 2 the
+# scan_data of a scan data file is a group of one dataset per statistic, with the start row of each obsid
+# in obsid_offsets, and all per-scan datasets are chunked by scan_chunk_size scans and compressed (the jk
+# data keeps its datasets). Version 1 is a single scan_data array (n_scans, 20, 4, n_stats), as always.
+# read_scan_data reads both, but version 2 breaks readers that open scan_data as one array, so version 1
+# stays the default until these are moved to read_scan_data.
+output_layout_version = 1
+scan_chunk_size = 256
+h5_compression = {'compression': 'gzip', 'compression_opts': 1, 'shuffle': True}
+
+# the accept and jackknife lists are made block by block of accept_block_size scans, ACCEPT_BLOCK_SIZE in
+# the parameter file. With ACCEPT_STREAMING the blocks are read from the scan data file, so scan_data is
+# never in memory as a whole. Both give the same results.
+accept_streaming = False
+accept_block_size = 4096
+
+# median cutoffs of the jackknife splits, JK_QUANTILE_MODE in the parameter file: 'exact', or 'sketch'
+# for QuantileSketch estimates in one pass over the scans, with rank error of about 2 / jk_sketch_k
+# (JK_SKETCH_K) of the number of accepted sidebands
+jk_quantile_mode = 'exact'
+jk_sketch_k = 200
+
 class spike_data():
     def __init__(self):
         self.spike_types = ['spike', 'jump', 'anomaly', 'edge spike']
@@ -60,7 +133,8 @@ class spike_list():
             typelist.sort(key=lambda x: np.abs(x.amp), reverse=True)  # hat tip: https://stackoverflow.com/a/403426/5238625
         return lists
 
-def get_spike_list(sb_mean, sd, scan_id, mjd):
+def get_spike_list(sb_mean, sd, scan_id, mjd, feeds=None):
+    # feeds (detector index of every row of sd and sb_mean) is used for the feed in s.ind
     # cutoff = 0.0015 * 8.0
     my_spikes = spike_list()
     for spike_type in range(3):
@@ -73,7 +147,8 @@ def get_spike_list(sb_mean, sd, scan_id, mjd):
             s = spike_data()
             s.amp = sd[0, max_sb[0], max_sb[1], spike_type, spike]
             s.sbs = sbs
-            s.ind = np.array((max_sb[0], max_sb[1], max_ind))  # feed, sb, ind
+            feed = max_sb[0] if feeds is None else feeds[max_sb[0]]
+            s.ind = np.array((feed, max_sb[1], max_ind))  # feed, sb, ind
             s.mjd = mjd[max_ind]
             s.data = sb_mean[max_sb[0], max_sb[1], max_ind - 200:max_ind + 200]
             s.type = spike_type
@@ -84,71 +159,298 @@ def get_spike_list(sb_mean, sd, scan_id, mjd):
 def get_sid(mjd):
     return 360 * ((1.002737811 * mjd) % 1)
 
-def make_map(ra, dec, ra_bins, dec_bins, tod, mask):
-    n_freq, n_samp = tod.shape
+def get_bin_index(x, bins):
+    # same binning as np.histogram with explicit edges (last bin closed), -1 outside
+    n_bins = len(bins) - 1
+    ind = np.searchsorted(bins, x, side='right') - 1
+    ind[x == bins[-1]] = n_bins - 1
+    ind[(ind < 0) | (ind >= n_bins)] = -1
+    return ind
+
+
+def get_pixel_index(ra, dec, ra_bins, dec_bins):
+    # flat pixel index (ra-major, as in np.histogram2d) of every sample, -1 if outside the grid
+    ind_ra = get_bin_index(ra, ra_bins)
+    ind_dec = get_bin_index(dec, dec_bins)
+    pix = ind_ra * (len(dec_bins) - 1) + ind_dec
+    pix[(ind_ra < 0) | (ind_dec < 0)] = -1
+    return pix
+
+
+def bin_sums(ind, n_bins, tod, channels):
+    # sums of the rows channels of tod (n_rows, n_samp) in the bins ind (-1 outside) of every
+    # sample, all channels in one bincount. The sums of consecutive sample blocks can be added.
+    hit = np.flatnonzero(ind >= 0)
+    n_chan = len(channels)
+    flat_ind = (ind[hit][None, :] + n_bins * np.arange(n_chan)[:, None]).ravel()
+    if len(hit) == len(ind):
+        weights = tod[channels].ravel()
+    else:
+        weights = tod[np.ix_(channels, hit)].ravel()
+    return np.bincount(flat_ind, weights=weights, minlength=n_chan * n_bins).reshape((n_chan, n_bins))
+
 
-    # print(ra_bins)
-    # print(dec_bins)
-    # print(ra.shape)
-    # print(dec.shape)
-    n_pix_ra = len(ra_bins) - 1
-    n_pix_dec = len(dec_bins) - 1
-    map = np.zeros((n_pix_ra, n_pix_dec, n_freq))
+def get_maps(sums, pix, n_pix_ra, n_pix_dec, channels, shape):
+    # map and nhit of shape (shape[:-1], n_pix_ra, n_pix_dec, n_freq) from the bin_sums of channels
+    n_pix = n_pix_ra * n_pix_dec
+    nhit_pix = np.bincount(pix[pix >= 0], minlength=n_pix).astype(np.float64)
+    where = nhit_pix > 0
+    map = np.zeros((int(np.prod(shape)), n_pix))
     nhit = np.zeros_like(map)
-    for i in range(n_freq):
-        if mask[i] == 1.0:
-            nhit[:, :, i] = np.histogram2d(ra, dec, bins=[ra_bins, dec_bins])[0]
-            where = np.where(nhit[:, :, i] > 0)
-            map[:, :, i][where] = np.histogram2d(ra, dec, bins=[ra_bins, dec_bins], weights=tod[i, :])[0][where] / nhit[:, :, i][where]
-    return map, nhit
+    map[channels[:, None], np.flatnonzero(where)[None, :]] = sums[:, where] / nhit_pix[where]
+    nhit[channels] = nhit_pix
+    map = np.moveaxis(map.reshape(shape + (n_pix_ra, n_pix_dec)), -3, -1)
+    nhit = np.moveaxis(nhit.reshape(shape + (n_pix_ra, n_pix_dec)), -3, -1)
+    return np.ascontiguousarray(map), np.ascontiguousarray(nhit)
+
+
+def bin_maps(pix, n_pix_ra, n_pix_dec, tod, mask):
+    # bins all channels of tod (..., n_freq, n_samp) with mask (..., n_freq) == 1.0 in one bincount,
+    # returns map and nhit of shape (..., n_pix_ra, n_pix_dec, n_freq)
+    channels = np.flatnonzero(mask.flatten() == 1.0)
+    sums = bin_sums(pix, n_pix_ra * n_pix_dec, tod.reshape((-1, tod.shape[-1])), channels)
+    return get_maps(sums, pix, n_pix_ra, n_pix_dec, channels, mask.shape)
+
+
+def make_map(ra, dec, ra_bins, dec_bins, tod, mask, pix=None):
+    if pix is None:
+        pix = get_pixel_index(ra, dec, ra_bins, dec_bins)
+    return bin_maps(pix, len(ra_bins) - 1, len(dec_bins) - 1, tod, mask)
+
+
+class PowerSpectrum():
+    # Binned power spectra of real maps of a fixed shape and k-binning. The k-grid, the bin
+    # index of every mode and the mode counts are computed once, after that a spectrum costs
+    # one rfftn and one bincount. Modes of the rfft half-space get weight 2 if their mirror
+    # image was dropped, so all binned quantities equal those of the full complex fftn.
+    def __init__(self, shape, k_bin_edges, dx=1, dy=1, dz=1):
+        self.shape = tuple(shape)
+        self.k_bin_edges = np.asarray(k_bin_edges)
+        self.dx, self.dy, self.dz = dx, dy, dz
+        self.n_k = len(k_bin_edges) - 1
+        self.k = (self.k_bin_edges[1:] + self.k_bin_edges[:-1]) / 2.0
+
+        n_x, n_y, n_z = self.shape
+        self.kx = np.fft.fftfreq(n_x, dx) * 2 * np.pi
+        self.ky = np.fft.fftfreq(n_y, dy) * 2 * np.pi
+        self.kz = np.fft.rfftfreq(n_z, dz) * 2 * np.pi
+        self.weight_z = np.full(len(self.kz), 2.0)
+        self.weight_z[0] = 1.0
+        if n_z % 2 == 0:
+            self.weight_z[-1] = 1.0
+        self._bins_3d = None
+        self._bins_2d = None
+        self._corr_3d = None
+        self._corr_2d = None
+
+    def _get_bins(self, kgrid, weights):
+        kgrid = kgrid.ravel()
+        ind = get_bin_index(kgrid, self.k_bin_edges)
+        ind[kgrid == 0] = -1
+        keep = np.flatnonzero(ind >= 0)
+        weights = weights.ravel()[keep]
+        nmodes = np.rint(np.bincount(ind[keep], weights=weights, minlength=self.n_k)).astype(int)
+        return keep, ind[keep], weights, nmodes
+
+    @property
+    def bins_3d(self):
+        if self._bins_3d is None:
+            kgrid = np.sqrt(self.kx[:, None, None] ** 2 + self.ky[None, :, None] ** 2 + self.kz[None, None, :] ** 2)
+            weights = np.broadcast_to(self.weight_z, kgrid.shape)
+            self._bins_3d = self._get_bins(kgrid, weights)
+        return self._bins_3d
+
+    @property
+    def bins_2d(self):
+        if self._bins_2d is None:
+            kgrid = np.sqrt(self.kx[:, None] ** 2 + self.ky[None, :] ** 2)
+            self._bins_2d = self._get_bins(kgrid, np.ones_like(kgrid))
+        return self._bins_2d
+
+    def _bin(self, p, bins):
+        # p has shape (..., n_modes), the leading axes are binned independently
+        keep, ind, weights, nmodes = bins
+        batch = p.shape[:-1]
+        p = p.reshape((-1, p.shape[-1]))[:, keep] * weights
+        n_batch = p.shape[0]
+        ind = (ind[None, :] + self.n_k * np.arange(n_batch)[:, None]).ravel()
+        Pk_nmodes = np.bincount(ind, weights=p.ravel(), minlength=n_batch * self.n_k).reshape((n_batch, self.n_k))
+        Pk = np.zeros_like(Pk_nmodes)
+        Pk[:, nmodes > 0] = Pk_nmodes[:, nmodes > 0] / nmodes[nmodes > 0]
+        return Pk.reshape(batch + (self.n_k,))
+
+    def fft_power(self, x):
+        # |rfftn|^2 over the last three axes, any leading axes are kept
+        return np.abs(fft.rfftn(x, axes=(-3, -2, -1))) ** 2
+
+    def bin_3d(self, p):
+        n_x, n_y, n_z = self.shape
+        p = p.reshape(p.shape[:-3] + (-1,)) * self.dx * self.dy * self.dz / (n_x * n_y * n_z)
+        return self._bin(p, self.bins_3d)
+
+    def bin_1d(self, p):
+        # mean over the pixels of the rfft along z (Parseval in x and y), without the k_z = 0 mode
+        n_x, n_y, n_z = self.shape
+        return p[..., 1:].sum((-3, -2)) * self.dz / n_z / (n_x * n_y) ** 2
+
+    def bin_2d(self, p):
+        # mean over z of the xy spectrum (Parseval in z), the binning makes the k_z half-space exact
+        n_x, n_y, n_z = self.shape
+        p = (p * self.weight_z).sum(-1) * self.dx * self.dy / (n_x * n_y) / n_z ** 2
+        return self._bin(p.reshape(p.shape[:-2] + (-1,)), self.bins_2d)
+
+    def _get_corr(self, ind, weights=1.0):
+        # autocorrelation A_b(q) = sum_k 1_b(k) 1_b(k + q) of every bin on the periodic k-grid
+        corr = np.zeros((self.n_k,) + ind.shape)
+        for b in range(self.n_k):
+            in_bin = (ind == b) * 1.0
+            if in_bin.any():
+                corr[b] = fft.ifftn(np.abs(fft.fftn(in_bin)) ** 2).real
+        return corr
+
+    @property
+    def corr_3d(self):
+        if self._corr_3d is None:
+            kz = np.fft.fftfreq(self.shape[2], self.dz) * 2 * np.pi
+            kgrid = np.sqrt(self.kx[:, None, None] ** 2 + self.ky[None, :, None] ** 2 + kz[None, None, :] ** 2)
+            ind = get_bin_index(kgrid.ravel(), self.k_bin_edges).reshape(kgrid.shape)
+            ind[kgrid == 0] = -1
+            corr = self._get_corr(ind)[..., :len(self.kz)] * self.weight_z
+            self._corr_3d = corr.reshape((self.n_k, -1))
+        return self._corr_3d
+
+    @property
+    def corr_2d(self):
+        if self._corr_2d is None:
+            kgrid = np.sqrt(self.kx[:, None] ** 2 + self.ky[None, :] ** 2)
+            ind = get_bin_index(kgrid.ravel(), self.k_bin_edges).reshape(kgrid.shape)
+            ind[kgrid == 0] = -1
+            self._corr_2d = self._get_corr(ind).reshape((self.n_k, -1))
+        return self._corr_2d
+
+    def noise_3d(self, var):
+        # Exact mean and std of the binned 3D spectrum of a white noise map with voxel variance var.
+        # E|F(k)|^2 = sum(var) for every k and Cov(|F(k)|^2, |F(k')|^2) = |V(k - k')|^2 + |V(k + k')|^2,
+        # V = fftn(var), which summed over a bin gives 2 sum_q |V(q)|^2 A_b(q) (the bins are symmetric).
+        n_x, n_y, n_z = self.shape
+        norm = self.dx * self.dy * self.dz / (n_x * n_y * n_z)
+        nmodes = self.bins_3d[3]
+        has_modes = nmodes > 0
+        ps_mean = np.zeros(self.n_k)
+        ps_var = np.zeros(self.n_k)
+        ps_mean[has_modes] = norm * np.sum(var)
+        ps_var[has_modes] = (2 * norm ** 2 * self.corr_3d.dot(self.fft_power(var).ravel()))[has_modes] / nmodes[has_modes] ** 2
+        return ps_mean, np.sqrt(np.maximum(ps_var, 0))
+
+    def noise_1d_2d(self, var):
+        # Same as noise_3d for the 1D (z) and binned 2D (xy) spectra of power_spec1d_2d.
+        n_x, n_y, n_z = self.shape
+        norm_1d = self.dz / n_z / (n_x * n_y)
+        var_z = fft.fft(var, axis=-1)
+        m = np.arange(1, len(self.kz))
+        ps_1D_mean = norm_1d * np.sum(var) + np.zeros(len(m))
+        ps_1D_var = norm_1d ** 2 * (np.sum(var_z[..., 0].real ** 2) + np.sum(np.abs(var_z[..., (2 * m) % n_z]) ** 2, axis=(0, 1)))
+
+        norm_2d = self.dx * self.dy / (n_x * n_y) / n_z
+        nmodes = self.bins_2d[3]
+        has_modes = nmodes > 0
+        ps_mean = np.zeros(self.n_k)
+        ps_var = np.zeros(self.n_k)
+        ps_mean[has_modes] = norm_2d * np.sum(var)
+        var_xy = np.sum(np.abs(fft.fft2(var, axes=(0, 1))) ** 2, axis=2)
+        ps_var[has_modes] = (2 * norm_2d ** 2 * self.corr_2d.dot(var_xy.ravel()))[has_modes] / nmodes[has_modes] ** 2
+        return ps_1D_mean, np.sqrt(ps_1D_var), ps_mean, np.sqrt(np.maximum(ps_var, 0))
+
+    def power_spec3d(self, x):
+        return self.bin_3d(self.fft_power(x)), self.k, self.bins_3d[3]
+
+    def power_spec1d_2d(self, x):
+        p = self.fft_power(x)
+        return self.bin_1d(p), self.bin_2d(p), self.k, self.bins_2d[3]
+
+
+power_spectra = collections.OrderedDict()  # LRU cache of PowerSpectrum objects, one per map shape and binning
+n_power_spectra_max = 64
+
+
+def get_power_spectrum(shape, k_bin_edges, dx=1, dy=1, dz=1):
+    key = (tuple(shape), float(dx), float(dy), float(dz), tuple(np.asarray(k_bin_edges, dtype=float)))
+    try:
+        power_spectra.move_to_end(key)
+        return power_spectra[key]
+    except KeyError:
+        if len(power_spectra) >= n_power_spectra_max:
+            power_spectra.popitem(last=False)
+        power_spectra[key] = PowerSpectrum(shape, k_bin_edges, dx, dy, dz)
+        return power_spectra[key]
 
 
 def compute_power_spec3d(x, k_bin_edges, dx=1, dy=1, dz=1):
-    n_x, n_y, n_z = x.shape
-    Pk_3D = np.abs(fft.fftn(x)) ** 2 * dx * dy * dz / (n_x * n_y * n_z)
-
-    kx = np.fft.fftfreq(n_x, dx) * 2 * np.pi
-    ky = np.fft.fftfreq(n_y, dy) * 2 * np.pi
-    kz = np.fft.fftfreq(n_z, dz) * 2 * np.pi
-
-    kgrid = np.sqrt(sum(ki ** 2 for ki in np.meshgrid(kx, ky, kz, indexing='ij')))
-
-    Pk_nmodes = np.histogram(kgrid[kgrid > 0], bins=k_bin_edges, weights=Pk_3D[kgrid > 0])[0]
-    nmodes = np.histogram(kgrid[kgrid > 0], bins=k_bin_edges)[0]
-
-    k = (k_bin_edges[1:] + k_bin_edges[:-1]) / 2.0
-    Pk = np.zeros_like(k)
-    Pk[np.where(nmodes > 0)] = Pk_nmodes[np.where(nmodes > 0)] / nmodes[np.where(nmodes > 0)]
-    return Pk, k, nmodes
+    return get_power_spectrum(x.shape, k_bin_edges, dx, dy, dz).power_spec3d(x)
 
 
 def compute_power_spec1d_2d(x, k_bin_edges, dx=1, dy=1, dz=1):
-    n_x, n_y, n_z = x.shape
-    Pk_1D = np.abs(fft.rfft(x, axis=2)) ** 2 * dz / n_z
-    kz = np.fft.rfftfreq(n_z, dz) * 2 * np.pi
-
-    Pk_1D = Pk_1D.mean((0, 1))
-    Pk_1D = Pk_1D[1:]
-
-    Pk_2D = np.abs(fft.fftn(x, axes=(0, 1))) ** 2 * (dx * dy) / (n_x * n_y)
-    kx = np.fft.fftfreq(n_x, dx) * 2 * np.pi
-    ky = np.fft.fftfreq(n_y, dy) * 2 * np.pi
-
-    kgrid = np.sqrt(sum(ki ** 2 for ki in np.meshgrid(kx, ky, indexing='ij')))
-
-    Pk_2D = Pk_2D.mean(2)
-
-    Pk_nmodes = np.histogram(kgrid[kgrid > 0], bins=k_bin_edges, weights=Pk_2D[kgrid > 0])[0]
-    nmodes = np.histogram(kgrid[kgrid > 0], bins=k_bin_edges)[0]
-
-    k = (k_bin_edges[1:] + k_bin_edges[:-1]) / 2.0
-    Pk = np.zeros_like(k)
-    Pk[np.where(nmodes > 0)] = Pk_nmodes[np.where(nmodes > 0)] / nmodes[np.where(nmodes > 0)]
-    return Pk_1D, Pk, k, nmodes
-
-
-def get_sb_ps(ra, dec, ra_bins, dec_bins, tod, mask, sigma, d_dec, n_k=10):
-    map, nhit = make_map(ra, dec, ra_bins, dec_bins, tod, mask)
+    return get_power_spectrum(x.shape, k_bin_edges, dx, dy, dz).power_spec1d_2d(x)
+
+
+def get_rng(*keys):
+    # reproducible generator for the noise simulations of one scan/obsid, independent of the worker
+    return np.random.default_rng([ps_sim_seed] + [int(key) for key in keys])
+
+
+def simulate_noise_ps(sigma, n_sim, rng, ps_3d=None, ps_2d=None, n_batch_max=2 ** 22):
+    # Draws n_sim noise maps with voxel std sigma as stacked batches of at most n_batch_max voxels.
+    # One rfftn per batch gives the 3D (ps_3d binning), 1D and 2D (ps_2d binning) spectra.
+    engine = ps_3d if ps_3d is not None else ps_2d
+    ps_arr = np.zeros((n_sim, ps_3d.n_k)) if ps_3d is not None else None
+    ps_arr_1D = np.zeros((n_sim, len(engine.kz) - 1)) if ps_2d is not None else None
+    ps_arr_2D = np.zeros((n_sim, ps_2d.n_k)) if ps_2d is not None else None
+    n_batch = max(1, min(n_sim, n_batch_max // sigma.size))
+    for l in range(0, n_sim, n_batch):
+        n = min(n_batch, n_sim - l)
+        p = engine.fft_power(rng.standard_normal((n,) + sigma.shape) * sigma)
+        if ps_3d is not None:
+            ps_arr[l:l + n] = ps_3d.bin_3d(p)
+        if ps_2d is not None:
+            ps_arr_1D[l:l + n] = ps_2d.bin_1d(p)
+            ps_arr_2D[l:l + n] = ps_2d.bin_2d(p)
+    return ps_arr, ps_arr_1D, ps_arr_2D
+
+
+def get_noise_ps(rms, n_k, d_th, dz, rng=None, spectra=('3d', '1d2d')):
+    # Mean and std of the noise power spectra of the weighted map w * map (w = 1 / rms^2) used in
+    # get_ps_chi2 ('3d') and get_ps_1d2d_chi2 ('1d2d'). In 'mc' mode all requested spectra come
+    # from the same set of simulations.
+    where = np.where(rms > 0)
+    w = np.zeros_like(rms)
+    w[where] = 1 / rms[where] ** 2
+    sigma = w * rms
+
+    ps_3d, ps_2d = None, None
+    if '3d' in spectra:
+        ps_3d = get_power_spectrum(rms.shape, np.logspace(-1.8, np.log10(0.5), n_k), d_th, d_th, dz)
+    if '1d2d' in spectra:
+        ps_2d = get_power_spectrum(rms.shape, np.logspace(-1.45, np.log10(0.1), n_k), d_th, d_th, dz)
+
+    noise_ps = {}
+    if ps_noise_mode == 'analytic':
+        if ps_3d is not None:
+            noise_ps['3d'] = ps_3d.noise_3d(sigma ** 2)
+        if ps_2d is not None:
+            noise_ps['1d2d'] = ps_2d.noise_1d_2d(sigma ** 2)
+    else:
+        if rng is None:
+            rng = np.random.default_rng()
+        ps_arr, ps_arr_1D, ps_arr_2D = simulate_noise_ps(sigma, n_sim_ps, rng, ps_3d, ps_2d)
+        if ps_3d is not None:
+            noise_ps['3d'] = (np.mean(ps_arr, axis=0), np.std(ps_arr, axis=0))
+        if ps_2d is not None:
+            noise_ps['1d2d'] = (np.mean(ps_arr_1D, axis=0), np.std(ps_arr_1D, axis=0),
+                                np.mean(ps_arr_2D, axis=0), np.std(ps_arr_2D, axis=0))
+    return noise_ps
+
+
+def get_sb_ps(map, nhit, sigma, d_dec, n_k=10, rng=None):
     h = 0.7
     deg2Mpc = 76.22 / h
     GHz2Mpc = 699.62 / h * (1 + 2.9) ** 2 / 115
@@ -165,17 +467,13 @@ def get_sb_ps(ra, dec, ra_bins, dec_bins, tod, mask, sigma, d_dec, n_k=10):
     w[where] = 1 / rms[where] ** 2
     # w = w / np.
 
-    Pk, k, nmodes = compute_power_spec3d(w * map, k_bin_edges, d_th, d_th, dz)
-    n_sim = 100
-    ps_arr = np.zeros((n_sim, n_k - 1))
-    for l in range(n_sim):
-        map_n = np.random.randn(*rms.shape) * rms
-        ps_arr[l] = compute_power_spec3d(w * map_n, k_bin_edges, d_th, d_th, dz)[0]
+    power_spectrum = get_power_spectrum(map.shape, k_bin_edges, d_th, d_th, dz)
+    Pk, k, nmodes = power_spectrum.power_spec3d(w * map)
+    ps_mean, ps_std = get_noise_ps(rms, n_k, d_th, dz, rng, spectra=('3d',))['3d']
     
     transfer = 1.0 / np.exp((0.055/k) ** 2.5)  # 6.7e5 / np.exp((0.055/k) ** 2.5)#1.0 / np.exp((0.03/k) ** 2)   ######## Needs to be tested!
     
-    ps_mean = np.mean(ps_arr, axis=0)
-    ps_std = np.std(ps_arr, axis=0) / transfer
+    ps_std = ps_std / transfer
     Pk = Pk / transfer
 
     n_chi2 = len(k)
@@ -236,9 +534,12 @@ def read_runlist(params):
         fieldname = lines[i][0]
         n_obsids = int(lines[i][1])
         i = i + 1
+        mjd_ranges = {}
         for j in range(n_obsids):
             obsid = lines[i][0]
             obsids.append(obsid)
+            if obsid_start <= int(obsid) <= obsid_stop:
+                mjd_ranges[obsid] = (float(lines[i][1]), float(lines[i][2]))
             n_scans = int(lines[i][3])
             o_scans = []
             for k in range(1, n_scans - 1):
@@ -248,14 +549,72 @@ def read_runlist(params):
                         n_scans_tot += 1
             scans[obsid] = o_scans
             i = i + n_scans + 1 
-        fields[fieldname] = [obsids, scans, n_scans_tot]
+        fields[fieldname] = [obsids, scans, n_scans_tot, mjd_ranges]
         print(fieldname, n_scans_tot)
     return fields
 
 
+def scatter_feeds(x, pixels, fill=np.nan, n_det=20):
+    # per feed statistic of the feeds present in the file (first axis) padded to all n_det feeds
+    full = np.zeros((n_det,) + np.shape(x)[1:]) + fill
+    full[pixels] = x
+    return full
+
+
+stats_index = (None, {})  # stats_list and the position of each of its statistics
+
+
+def get_stats_index(stats_string):
+    # stats_list.index(stats_string), from a dict that is rebuilt when stats_list is replaced
+    global stats_index
+    if stats_index[0] is not stats_list:
+        stats_index = (stats_list, {stat_string: k for k, stat_string in reversed(list(enumerate(stats_list)))})
+    try:
+        return stats_index[1][stats_string]
+    except KeyError:
+        raise ValueError('%s is not in stats_list' % stats_string)
+
+
+class ScanStatsTable():
+    # Scan statistics stored statistic-major: data[k] is statistic stats[k] of all sidebands, a contiguous
+    # (n_scans, n_det, n_sb) array, and table[stat_string] is a view of it. shape is that of the scan_data
+    # array (n_scans, n_det, n_sb, n_stats) of the h5 files, which from_array and to_array convert from and to.
+    def __init__(self, data, stats):
+        self.data = data
+        self.stats = list(stats)
+        self.index = {stat_string: k for k, stat_string in reversed(list(enumerate(self.stats)))}
+
+    @classmethod
+    def from_array(cls, scan_data, stats):
+        return cls(np.ascontiguousarray(np.moveaxis(scan_data, -1, 0)), stats)
+
+    def to_array(self):
+        return np.ascontiguousarray(np.moveaxis(self.data, 0, -1))
+
+    @property
+    def shape(self):
+        return self.data.shape[1:] + self.data.shape[:1]
+
+    def __contains__(self, stat_string):
+        return stat_string in self.index
+
+    def __getitem__(self, stat_string):
+        return self.data[self.index[stat_string]]
+
+    def __setitem__(self, stat_string, values):
+        self.data[self.index[stat_string]] = values
+
+
+def get_scan_stats_table(scan_data):
+    # scan_data as a ScanStatsTable, with the statistics of stats_list
+    if isinstance(scan_data, ScanStatsTable):
+        return scan_data
+    return ScanStatsTable.from_array(scan_data, stats_list)
+
+
 def insert_data_in_array(data, indata, stats_string, obsid=False):
     try:
-        index = stats_list.index(stats_string)
+        index = get_stats_index(stats_string)
         if obsid:
             data[:, :, :, index] = indata
         else:
@@ -265,33 +624,278 @@ def insert_data_in_array(data, indata, stats_string, obsid=False):
 
 
 def extract_data_from_array(data, stats_string):
+    if isinstance(data, ScanStatsTable):
+        if stats_string in data:
+            return data[stats_string]
+        print('Did not find statistic "' + stats_string + '" in stats list.')
+        return 0
     try:
-        index = stats_list.index(stats_string)
+        index = get_stats_index(stats_string)
         outdata = data[:,:,:, index]
         return outdata
     except ValueError:
         print('Did not find statistic "' + stats_string + '" in stats list.')
         return 0
 
-def get_scan_stats(filepath, map_grid=None):
+def get_az_bins(az, nbins=15):
+    # azimuth bin of every sample of one feed, nbins equal bins over its azimuth range, and the
+    # number of samples in each bin
+    bins = np.histogram_bin_edges(az, bins=nbins)
+    ind = get_bin_index(az, bins)
+    return ind, np.bincount(ind, minlength=nbins)
+
+
+def get_az_chi2(histsum, nhit, sigma0, mask, sb_acc, channels):
+    # chi2 of the azimuth binned, normalized timestreams of one feed, from the bin_sums histsum of
+    # its tod over the channels (flat indices into (n_sb, n_freq)) and the hits nhit per azimuth bin.
+    # Returns full, max and median chi2 of the accepted sidebands sb_acc.
+    n_sb, n_freq = mask.shape
+    nbins = len(nhit)
+    normhist = histsum / sigma0.reshape(-1)[channels, None] / nhit * np.sqrt(nhit)
+
+    freq_chi2 = np.zeros(n_sb * n_freq)
+    freq_chi2[channels] = (np.sum(normhist ** 2, axis=1) - nbins) / np.sqrt(2 * nbins)
+    freq_chi2 = freq_chi2.reshape((n_sb, n_freq))[sb_acc]
+    full_az_chi2 = np.sum(freq_chi2, axis=1) / np.sqrt(np.sum(mask[sb_acc], axis=1))
+    return full_az_chi2, np.max(freq_chi2, axis=1), np.median(freq_chi2, axis=1)
+
+
+def get_moment_sums(tod, sigma0, mask):
+    # number of samples n, mean and central sums M_p = sum (tod / sigma0 - mean)^p, p = 2..4, over the
+    # unmasked channels of each sideband of one feed (tod is (n_sb, n_freq, n_samp)). The normalized tod
+    # of the unmasked channels is copied once and centered in place, the three central sums then come
+    # from its square. Central sums keep their precision when the mean is much larger than sigma0, and
+    # the sums of consecutive sample blocks are combined with add_moment_sums.
+    n_sb, n_freq, n_samp = tod.shape
+    channels = np.flatnonzero(mask > 0.0)
+    sb = channels // n_freq
+    x = tod.reshape((n_sb * n_freq, n_samp))[channels] * (1.0 / sigma0.reshape(-1)[channels])[:, None]
+    sums = np.zeros((5, n_sb))
+    sums[0] = np.bincount(sb, minlength=n_sb) * n_samp
+    sums[1] = np.bincount(sb, weights=np.sum(x, axis=1), minlength=n_sb) / np.maximum(sums[0], 1)
+    x -= sums[1][sb, None]
+    x2 = x * x
+    sums[2] = np.bincount(sb, weights=np.sum(x2, axis=1), minlength=n_sb)
+    sums[3] = np.bincount(sb, weights=np.einsum('ct,ct->c', x2, x), minlength=n_sb)
+    sums[4] = np.bincount(sb, weights=np.einsum('ct,ct->c', x2, x2), minlength=n_sb)
+    return sums
+
+
+def add_moment_sums(a, b):
+    # get_moment_sums of the samples of both a and b (pairwise update of the central sums)
+    n_a, mean_a, m2_a, m3_a, m4_a = a
+    n_b, mean_b, m2_b, m3_b, m4_b = b
+    n = n_a + n_b
+    n_safe = np.maximum(n, 1)
+    delta = mean_b - mean_a
+    sums = np.zeros_like(a)
+    sums[0] = n
+    sums[1] = mean_a + delta * n_b / n_safe
+    sums[2] = m2_a + m2_b + delta ** 2 * n_a * n_b / n_safe
+    sums[3] = (m3_a + m3_b + delta ** 3 * n_a * n_b * (n_a - n_b) / n_safe ** 2
+               + 3 * delta * (n_a * m2_b - n_b * m2_a) / n_safe)
+    sums[4] = (m4_a + m4_b + delta ** 4 * n_a * n_b * (n_a ** 2 - n_a * n_b + n_b ** 2) / n_safe ** 3
+               + 6 * delta ** 2 * (n_a ** 2 * m2_b + n_b ** 2 * m2_a) / n_safe ** 2
+               + 4 * delta * (n_a * m3_b - n_b * m3_a) / n_safe)
+    return sums
+
+
+def get_moments(sums):
+    # kurtosis and skewness (as scipy.stats.kurtosis and scipy.stats.skew) from get_moment_sums
+    n = sums[0]
+    with np.errstate(invalid='ignore', divide='ignore'):
+        kurtosis = n * sums[4] / sums[2] ** 2 - 3.0
+        skewness = np.sqrt(n) * sums[3] / sums[2] ** 1.5
+    return kurtosis, skewness
+
+
+class TodSums():
+    # Sums over the samples of the tod (n_sb, n_freq, n_samp) of one feed that the tod based scan
+    # statistics need: the moment sums and the bin_sums of a set of binnings (azimuth histogram,
+    # maps), given as name: (bin index of every sample, n_bins, channels). Blocks of consecutive
+    # samples are added one at a time, so the tod of the feed never has to be in memory at once.
+    def __init__(self, sigma0, mask, binnings):
+        self.sigma0 = sigma0
+        self.mask = mask
+        self.binnings = binnings
+        self.moment_sums = np.zeros((5, mask.shape[0]))
+        self.bin_sums = {}
+        for name, (ind, n_bins, channels) in binnings.items():
+            self.bin_sums[name] = np.zeros((len(channels), n_bins))
+
+    def add(self, tod, start=0):
+        # tod holds the samples start:start + tod.shape[-1]
+        stop = start + tod.shape[-1]
+        self.moment_sums = add_moment_sums(self.moment_sums, get_moment_sums(tod, self.sigma0, self.mask))
+        tod = tod.reshape((-1, tod.shape[-1]))
+        for name, (ind, n_bins, channels) in self.binnings.items():
+            self.bin_sums[name] += bin_sums(ind[start:stop], n_bins, tod, channels)
+
+
+def get_tod_block_size(shape, chunks=None):
+    # number of samples of one feed read at a time in streaming mode, so that the block and the
+    # temporaries of TodSums.add (about 32 bytes per tod element) stay below scan_stats_memory_limit
+    n_det, n_sb, n_freq, n_samp = shape
+    n_block = int(scan_stats_memory_limit * 2 ** 20 // (32 * n_sb * n_freq))
+    if chunks is not None and n_block >= chunks[-1]:
+        n_block -= n_block % chunks[-1]  # whole hdf5 chunks
+    return min(max(n_block, 1), n_samp)
+
+
+def iter_tod_blocks(filepath, k, tod=None):
+    # yields (first sample, tod block (n_sb, n_freq, n_block)) of the feed in row k of the level2
+    # file, all samples in one block if tod is in memory, otherwise hyperslabs of
+    # get_tod_block_size samples read from the file
+    if tod is not None:
+        yield 0, tod[k]
+        return
+    with h5py.File(filepath, mode="r") as my_file:
+        dset = my_file['tod']
+        n_block = get_tod_block_size(dset.shape, dset.chunks)
+        for start in range(0, dset.shape[-1], n_block):
+            block = dset[k, :, :, start:start + n_block]
+            block[~np.isfinite(block)] = 0
+            yield start, block
+
+
+# auxiliary data of the scan statistics, read once per process and shared by all scans. get_scan_data
+# loads it before creating the pool, so the workers inherit it read-only.
+weather_table = None  # (obsids, rows) of the weather file, sorted by obsid
+sw_tables = {}  # per field (obsids, sw_stats), sorted by obsid
+sw_filepath = '/mn/stornext/d22/cmbco/comap/d16/protodir/sw_complete_%s.h5'
+
+
+def get_weather_table():
+    global weather_table
+    if weather_table is None:
+        weather = np.loadtxt(weather_filepath, ndmin=2)
+        weather = weather[np.argsort(weather[:, 0], kind='stable')]  # keeps the file order of each obsid
+        weather_table = (weather[:, 0], weather)
+    return weather_table
+
+
+def get_weather_rows(obsid):
+    # rows of the weather file (obsid, ..., forecast, mjd) of one obsid, in file order
+    obsids, weather = get_weather_table()
+    return weather[np.searchsorted(obsids, obsid, side='left'):np.searchsorted(obsids, obsid, side='right')]
+
+
+def get_sw_table(fieldname):
+    if fieldname not in sw_tables:
+        obsids = []
+        sw_stats = []
+        try:
+            with h5py.File(sw_filepath % fieldname, mode="r") as my_file:
+                for key in my_file:
+                    if key.isdigit() and 'sw_stats' in my_file[key]:
+                        obsids.append(int(key))
+                        sw_stats.append(my_file[key]['sw_stats'][()])
+        except OSError:
+            print('Found no standing wave file for field', fieldname)
+        order = np.argsort(obsids)
+        sw_tables[fieldname] = (np.array(obsids, dtype=int)[order], [sw_stats[i] for i in order])
+    return sw_tables[fieldname]
+
+
+def get_sw_stats(fieldname, obsid):
+    # standing wave statistics (n_det, n_scans, n_sw) of one obsid, KeyError if there are none
+    obsids, sw_stats = get_sw_table(fieldname)
+    i = np.searchsorted(obsids, obsid)
+    if i == len(obsids) or obsids[i] != obsid:
+        raise KeyError('No standing wave statistics for obsid %i' % obsid)
+    return sw_stats[i]
+
+
+# sun and moon directions (unit vectors in the horizontal frame of the telescope) tabulated every
+# ephemeris_step days over the obsids of the run, made once by make_ephemeris before the pool is created.
+# Linear interpolation of the unit vectors between them is accurate to better than 0.002 deg.
+ephemeris_step = 5.0 / (24 * 60)
+ephemeris = None  # (grid index, mjd, {body: unit vectors (n, 3)})
+
+
+def get_altaz(body, mjd):
+    # alt and az in degrees of 'sun' or 'moon' from the telescope at the times mjd, straight from astropy
+    with solar_system_ephemeris.set('builtin'):
+        loc = coord.EarthLocation(lon=-118.283 * u.deg, lat=37.2313 * u.deg)
+        time = Time(mjd, format='mjd')
+        aa = AltAz(location=loc, obstime=time)
+        c = get_body(body, time, loc).transform_to(aa)
+    return c.alt.deg, c.az.deg
+
+
+def make_ephemeris(fields, step=ephemeris_step):
+    # tabulates the sun and moon in one astropy call each, on the multiples of step covering the
+    # mjd ranges of all obsids in the runlist (fields from read_runlist)
+    global ephemeris
+    ind = []
+    for field in fields.values():
+        for mjd_start, mjd_end in field[3].values():
+            ind.append(np.arange(np.floor(mjd_start / step) - 1, np.ceil(mjd_end / step) + 2))
+    if len(ind) == 0:
+        return
+    ind = np.unique(np.concatenate(ind)).astype(int)
+    mjd = ind * step
+    pos = {}
+    for body in ['sun', 'moon']:
+        alt, az = np.radians(get_altaz(body, mjd))
+        pos[body] = np.array([np.cos(alt) * np.cos(az), np.cos(alt) * np.sin(az), np.sin(alt)]).T
+    ephemeris = (ind, mjd, pos)
+
+
+def get_body_altaz(body, mjd):
+    # alt and az in degrees of 'sun' or 'moon' at the time mjd, interpolated in the ephemeris table
+    # if it covers mjd, otherwise computed directly
+    if ephemeris is not None:
+        ind, grid, pos = ephemeris
+        i = np.searchsorted(grid, mjd, side='right') - 1
+        if 0 <= i < len(grid) - 1 and ind[i + 1] == ind[i] + 1:
+            w = (mjd - grid[i]) / (grid[i + 1] - grid[i])
+            x, y, z = (1 - w) * pos[body][i] + w * pos[body][i + 1]
+            alt = np.degrees(np.arctan2(z, np.sqrt(x ** 2 + y ** 2)))
+            az = np.degrees(np.arctan2(y, x)) % 360
+            return alt, az
+    return get_altaz(body, mjd)
+
+
+def get_sidelobe_flags(dist, angle):
+    # central (1 within 40 deg, 2 within 30 deg of the pointing) and outer (the four lobes 58 to 75 deg
+    # out along the focal plane axes, 2 in their cores) sidelobe flags of a source at distance dist
+    # and angle (deg) from the pointing, any array shape
+    angle_mod90 = angle % 90
+    central_sl = 1.0 * (dist < 40) + 1.0 * (dist < 30)
+    cond_1 = (dist > 58.0) * (dist < 75.0) * (angle_mod90 > 75.0)
+    cond_2 = (dist > 58.0) * (dist < 75.0) * (angle_mod90 < 15.0)
+    cond_3 = (dist > 63.0) * (dist < 70.0) * (angle_mod90 > 82.0)
+    cond_4 = (dist > 63.0) * (dist < 70.0) * (angle_mod90 < 8.0)
+    outer_sl = 1.0 * cond_1 + 1.0 * cond_2 + 1.0 * cond_3 + 1.0 * cond_4  # can never be more than 2.0
+    return central_sl, outer_sl
+
+
+def get_scan_stats(filepath, map_grid=None, fieldname=None):
     n_stats = len(stats_list)
     # try:
     with h5py.File(filepath, mode="r") as my_file:
-        tod_ind = np.array(my_file['tod'][:])
-        tod_ind[~np.isfinite(tod_ind)] = 0
-        # print(np.sum(np.isfinite(tod_ind)), np.size(tod_ind), tod_ind.shape)
-        n_det_ind, n_sb, n_freq, n_samp = tod_ind.shape
-        sb_mean_ind = np.array(my_file['sb_mean'][:])
-        point_tel_ind = np.array(my_file['point_tel'][:])
-        point_radec_ind = np.array(my_file['point_cel'][:])
-        # mask_ind = my_file['freqmask'][:]
-        # mask_full_ind = my_file['freqmask_full'][:]
-        mask_ind = my_file['freqmask'][:]
-        mask_full_ind = my_file['freqmask_full'][:]
-        reason_ind = my_file['freqmask_reason'][:]
-        sigma0_ind = my_file['sigma0'][()]
-        # n_nan_ind = my_file['n_nan'][()]
-        # n_nan_ind = my_file['n_nans'][()]
+        # all arrays are kept for the feeds present in the file only, the tod also in the file dtype,
+        # and only the final (n_det, n_sb) statistics are scattered to all feeds (see scatter_feeds).
+        # In streaming mode the tod is not loaded here, but read one feed and block at a time.
+        n_det_ind, n_sb, n_freq, n_samp = my_file['tod'].shape
+        if scan_stats_streaming:
+            tod = None
+        else:
+            tod = my_file['tod'][()]
+            tod[~np.isfinite(tod)] = 0
+        # print(np.sum(np.isfinite(tod)), np.size(tod), tod.shape)
+        sb_mean = np.asarray(my_file['sb_mean'][()], dtype=np.float64)
+        point_tel = np.asarray(my_file['point_tel'][()], dtype=np.float64)
+        point_radec = np.asarray(my_file['point_cel'][()], dtype=np.float64)
+        # mask = my_file['freqmask'][:]
+        # mask_full = my_file['freqmask_full'][:]
+        mask = np.asarray(my_file['freqmask'][()], dtype=np.float64)
+        mask_full = np.asarray(my_file['freqmask_full'][()], dtype=np.float64)
+        # reason = my_file['freqmask_reason'][:]
+        sigma0 = np.asarray(my_file['sigma0'][()], dtype=np.float64)
+        # n_nan = my_file['n_nan'][()]
+        # n_nan = my_file['n_nans'][()]
 
         # pixels = np.array(my_file['pixels'][:]) - 1 
         pixels = np.array(my_file['feeds'][:]) - 1 
@@ -310,51 +914,51 @@ def get_scan_stats(filepath, map_grid=None):
         windspeed = np.mean(my_file['hk_windspeed'][()])
         
         # try:
-        point_amp_ind = my_file['el_az_amp'][:,:,:,:2]
-            # point_amp_ind = np.nanmean(my_file['el_az_stats'][()], axis=3) #### mean over chunk axis
+        point_amp = np.asarray(my_file['el_az_amp'][:,:,:,:2], dtype=np.float64)
+            # point_amp = np.nanmean(my_file['el_az_stats'][()], axis=3) #### mean over chunk axis
             # 3, 19, 4, 1024 => 19, 4, 1024, 2
         # except:
-        #     point_amp_ind = np.zeros((n_det_ind, n_sb, 1024, 2))
+        #     point_amp = np.zeros((n_det_ind, n_sb, 1024, 2))
         try: 
-            sd_ind = np.array(my_file['spike_data'])
-            if (sd_ind.shape[0] == 0):
-                sd_ind = np.zeros((3, n_det_ind, n_sb, 4, 1000))
+            sd = np.array(my_file['spike_data'])
+            if (sd.shape[0] == 0):
+                sd = np.zeros((3, n_det_ind, n_sb, 4, 1000))
         except:
-            sd_ind = np.zeros((3, n_det_ind, n_sb, 4, 1000))
+            sd = np.zeros((3, n_det_ind, n_sb, 4, 1000))
         # use_freq_filter = my_file['use_freq_filter'][()]
         # if not use_freq_filter:
-            # tod_poly_ind = my_file['tod_poly'][()]
+            # tod_poly = my_file['tod_poly'][()]
         # try:
         if "poly_coeff" in my_file:
-            tod_poly_ind = np.transpose(my_file['poly_coeff'][()], (1,2,0,3))
+            tod_poly = np.transpose(my_file['poly_coeff'][()], (1,2,0,3))
         else:
-            tod_poly_ind = np.zeros((n_det_ind, n_sb, 2, n_samp))
+            tod_poly = np.zeros((n_det_ind, n_sb, 2, n_samp))
         # except KeyError:
-        #     tod_poly_ind = np.zeros((n_det_ind, n_sb, 2, n_samp))
+        #     tod_poly = np.zeros((n_det_ind, n_sb, 2, n_samp))
         # try: 
-        chi2_ind = np.array(my_file['chi2'])
+        chi2 = np.asarray(my_file['chi2'][()], dtype=np.float64)
         # except KeyError:
-        #     chi2_ind = np.zeros_like(tod_ind[:,:,:,0])
+        #     chi2 = np.zeros_like(tod[:,:,:,0])
         try:
-            acc_ind = np.array(my_file['acceptrate'])
+            acc = np.asarray(my_file['acceptrate'][()], dtype=np.float64)
         except KeyError:
-            acc_ind = np.zeros_like(tod_ind[:,:,0,0])
+            acc = np.zeros((n_det_ind, n_sb))
             print("Found no acceptrate")
         time = np.array(my_file['tod_time'])
         mjd = time
         try:
             pca = np.array(my_file['pca_comp'])
             # eigv = np.array(my_file['pca_eigv'])
-            ampl_ind = np.array(my_file['pca_ampl'])
+            ampl = np.asarray(my_file['pca_ampl'][()], dtype=np.float64)
         except KeyError:
             pca = np.zeros((4, 10000))
             # eigv = np.zeros(0)
-            ampl_ind = np.zeros((4, *mask_full_ind.shape))
+            ampl = np.zeros((4, *mask_full.shape))
             print('Found no pca comps', scanid)
         try:
-            tsys_ind = np.array(my_file['Tsys_lowres'])
+            tsys = np.asarray(my_file['Tsys_lowres'][()], dtype=np.float64)
         except KeyError:
-            tsys_ind = np.zeros_like(tod_ind[:,:,:,0]) + 40
+            tsys = np.zeros((n_det_ind, n_sb, n_freq)) + 40
             print("Found no tsys")
     # except KeyboardInterrupt:
     #     sys.exit()
@@ -372,57 +976,26 @@ def get_scan_stats(filepath, map_grid=None):
  
     obsid = int(str(scanid)[:-2])
 
-    n_freq_hr = len(mask_full_ind[0,0])
+    n_freq_hr = len(mask_full[0,0])
     n_det = 20
 
     data = np.zeros((n_det, n_sb, n_stats), dtype=np.float32)
 
-    ## transform to full arrays with all pixels
-    tod = np.zeros((n_det, n_sb, n_freq, n_samp))
-    mask = np.zeros((n_det, n_sb, n_freq))
-    mask_full = np.zeros((n_det, n_sb, n_freq_hr))
-    # n_nan = np.zeros((n_det, n_sb, n_freq_hr))
-    acc = np.zeros((n_det, n_sb))
-    ampl = np.zeros((4, n_det, n_sb, n_freq_hr))
-    tsys = np.zeros((n_det, n_sb, n_freq))
-    chi2 = np.zeros((n_det, n_sb, n_freq))
-    sd = np.zeros((3, n_det, n_sb, 4, 1000))
-    sb_mean = np.zeros((n_det, n_sb, n_samp))
-    reason = np.zeros((n_det, n_sb, n_freq_hr))
-    sigma0 = np.zeros((n_det, n_sb, n_freq))
-    point_amp = np.zeros((n_det, n_sb, n_freq_hr, 2))
-    tod_poly = np.zeros((n_det, n_sb, 2, n_samp))
-    point_tel = np.zeros((n_det, n_samp, 3))
-    point_radec = np.zeros((n_det, n_samp, 3))
-
-    tod[pixels] = tod_ind
-    mask[pixels] = mask_ind
-    mask_full[pixels] = mask_full_ind
-    # n_nan[pixels] = n_nan_ind
-    reason[pixels] = reason_ind
-    acc[pixels] = acc_ind
-    ampl[:, pixels, :, :] = ampl_ind
-    tsys[pixels] = tsys_ind
-    chi2[pixels] = chi2_ind
-    sd[:, pixels, :, :, :] = sd_ind
-    sb_mean[pixels] = sb_mean_ind
-    sigma0[pixels] = sigma0_ind
-    point_amp[pixels] = point_amp_ind
-    tod_poly[pixels] = tod_poly_ind
-    point_tel[pixels,:,:2] = point_tel_ind
-    point_radec[pixels,:,:2] = point_radec_ind
+    # row in the file arrays of every feed, -1 if the feed is missing
+    feed_ind = np.zeros(n_det, dtype=int) - 1
+    feed_ind[pixels] = np.arange(n_det_ind)
 
     az_amp = point_amp[:, :, :, 1]
     el_amp = point_amp[:, :, :, 0]
 
 
-    mask_sum = np.nansum(mask_full.reshape((n_det, n_sb, n_freq, 16)), axis=3)
+    mask_sum = np.nansum(mask_full.reshape((n_det_ind, n_sb, n_freq, 16)), axis=3)
     az_amp = az_amp * mask_full
     el_amp = el_amp * mask_full
 
-    az_amp_lowres = np.nansum(az_amp.reshape((n_det, n_sb, n_freq, 16)), axis=3) / mask_sum
+    az_amp_lowres = np.nansum(az_amp.reshape((n_det_ind, n_sb, n_freq, 16)), axis=3) / mask_sum
     
-    el_amp_lowres = np.nansum(el_amp.reshape((n_det, n_sb, n_freq, 16)), axis=3) / mask_sum
+    el_amp_lowres = np.nansum(el_amp.reshape((n_det_ind, n_sb, n_freq, 16)), axis=3) / mask_sum
 
     mask_sb_sum = np.nansum(mask_full, axis=2)
     where = (mask_sb_sum > 0)
@@ -431,7 +1004,7 @@ def get_scan_stats(filepath, map_grid=None):
     az_amp_sb[where] = np.nansum(az_amp, axis=2)[where] / mask_sb_sum[where]
     el_amp_sb[where] = np.nansum(el_amp, axis=2)[where] / mask_sb_sum[where]
 
-    my_spikes = get_spike_list(sb_mean, sd, str(scanid), mjd)
+    my_spikes = get_spike_list(sb_mean, sd, str(scanid), mjd, feeds=pixels)
     sortedlists = my_spikes.sorted()
     n_spikes = len(sortedlists[0])
     n_jumps = len(sortedlists[1])
@@ -439,9 +1012,12 @@ def get_scan_stats(filepath, map_grid=None):
 
     # cutoff = 0.0015 * 8.0
     n_sigma_spikes = 5         # Get from param file   ########################
-    n_spikes_sb = (np.array([s.sbs for s in sortedlists[0]]) > 0.0015 * n_sigma_spikes).sum(0)
-    n_jumps_sb = (np.array([s.sbs for s in sortedlists[1]]) > 0.0015 * n_sigma_spikes).sum(0)
-    n_anom_sb = (np.array([s.sbs for s in sortedlists[2]]) > 0.0015 * n_sigma_spikes).sum(0)
+    n_spikes_sb = np.zeros((n_det_ind, n_sb))
+    n_jumps_sb = np.zeros((n_det_ind, n_sb))
+    n_anom_sb = np.zeros((n_det_ind, n_sb))
+    n_spikes_sb += (np.array([s.sbs for s in sortedlists[0]]) > 0.0015 * n_sigma_spikes).sum(0)
+    n_jumps_sb += (np.array([s.sbs for s in sortedlists[1]]) > 0.0015 * n_sigma_spikes).sum(0)
+    n_anom_sb += (np.array([s.sbs for s in sortedlists[2]]) > 0.0015 * n_sigma_spikes).sum(0)
     
     mask_sb_sum_lowres = np.nansum(mask, axis=2)
     tsys_sb = np.nansum((tsys * mask), axis=2) / mask_sb_sum_lowres
@@ -471,16 +1047,16 @@ def get_scan_stats(filepath, map_grid=None):
     # sidereal time in degrees (up to a phase)
     insert_data_in_array(data, get_sid(scan_mjd), 'sidereal')
 
-    # Mean az/el per feed
+    # Mean az/el per feed, zero for missing feeds
     mean_el = np.zeros((n_det, n_sb))
     mean_az = np.zeros((n_det, n_sb))
 
     # mean_az[:, :] = np.mean(point_tel[:, :, 0], axis=1)[:, None]
-    mean_az[:, :] = np.arctan2(np.mean(np.sin(point_tel[:, :, 0] * np.pi / 180), axis=1), 
-                             np.mean(np.cos(point_tel[:, :, 0] * np.pi / 180), axis=1)
-                             )[:, None] * 180 / np.pi
+    mean_az[pixels, :] = np.arctan2(np.mean(np.sin(point_tel[:, :, 0] * np.pi / 180), axis=1),
+                                  np.mean(np.cos(point_tel[:, :, 0] * np.pi / 180), axis=1)
+                                  )[:, None] * 180 / np.pi
     mean_az[:, :] = (mean_az[:, :] + 360) % 360
-    mean_el[:, :] = np.mean(point_tel[:, :, 1], axis=1)[:, None]
+    mean_el[pixels, :] = np.mean(point_tel[:, :, 1], axis=1)[:, None]
     
 
 
@@ -495,62 +1071,24 @@ def get_scan_stats(filepath, map_grid=None):
     chi2_sb[wh] = chi2_sb[wh] / np.sqrt(n_freq_sb[wh])
     wh = np.where(n_freq_sb == 0.0)
     chi2_sb[wh] = np.nan
-    insert_data_in_array(data, chi2_sb, 'chi2')
+    insert_data_in_array(data, scatter_feeds(chi2_sb, pixels), 'chi2')
  
     # acceptrate
-    insert_data_in_array(data, acc, 'acceptrate')
-
-    # azimuth binning
-    nbins = 15                                ##### azimuth bins
-    full_az_chi2 = np.zeros((n_det, n_sb))
-    max_az_chi2 = np.zeros((n_det, n_sb))
-    med_az_chi2 = np.zeros((n_det, n_sb))
-    full_az_chi2[:] = np.nan
-    max_az_chi2[:] = np.nan
-    med_az_chi2[:] = np.nan
-    az = point_tel[:, :, 0]
-    for i in range(n_det):
-        for j in range(n_sb):
-            if acc[i, j]:
-                freq_chi2 = np.zeros(n_freq)
-                for k in range(n_freq): 
-                    if mask[i, j, k]:
-                        histsum, bins = np.histogram(az[i], bins=nbins, weights=(tod[i, j, k]/sigma0[i,j,k]))
-                        nhit = np.histogram(az[i], bins=nbins)[0]
-                        normhist = histsum / nhit * np.sqrt(nhit)
-
-                        # if i == 15 and j == 3 and k == 24:
-                        #     print(scanid)
-                        #     plt.errorbar(bins[1:], normhist, yerr=1/np.sqrt(nhit), fmt='-o')
-                        #     plt.show()
-                        freq_chi2[k] = (np.sum(normhist ** 2) - nbins) / np.sqrt(2 * nbins)
-                        # if freq_chi2[k] > 4.0:
-                        #     file = open('diag_az_bins.txt', 'a')
-                        #     print(scanid, i+1, j+1, k+1, freq_chi2[k], scan_mjd, mean_az, mean_el, 
-                        #           chi2[i,j,k], chi2_sb[i,j], tsys[i,j,k], feat, az_amp_lowres[i,j,k],
-                        #           az_amp_sb[i,j], np.argmax(normhist ** 2),
-                        #           file=file)
-                        #     file.close()        
-                full_az_chi2[i, j] = np.sum(freq_chi2) / np.sqrt(np.sum(mask[i,j]))
-                max_az_chi2[i, j] = np.max(freq_chi2)
-                med_az_chi2[i, j] = np.median(freq_chi2)
-    insert_data_in_array(data, full_az_chi2, 'az_chi2')
-    insert_data_in_array(data, max_az_chi2, 'max_az_chi2')
-    insert_data_in_array(data, med_az_chi2, 'med_az_chi2')
+    insert_data_in_array(data, scatter_feeds(acc, pixels, 0.0), 'acceptrate')
 
     # featurebit
     insert_data_in_array(data, feat, 'fbit')
 
     # az-amplitude
-    insert_data_in_array(data, az_amp_sb, 'az_amp')
+    insert_data_in_array(data, scatter_feeds(az_amp_sb, pixels, 0.0), 'az_amp')
 
     # el-amplitude
-    insert_data_in_array(data, el_amp_sb, 'el_amp')
+    insert_data_in_array(data, scatter_feeds(el_amp_sb, pixels, 0.0), 'el_amp')
 
     # number of spikes, jumps, and anomalies
-    insert_data_in_array(data, n_spikes_sb, 'n_spikes')
-    insert_data_in_array(data, n_jumps_sb, 'n_jumps')
-    insert_data_in_array(data, n_anom_sb, 'n_anomalies')
+    insert_data_in_array(data, scatter_feeds(n_spikes_sb, pixels, 0.0), 'n_spikes')
+    insert_data_in_array(data, scatter_feeds(n_jumps_sb, pixels, 0.0), 'n_jumps')
+    insert_data_in_array(data, scatter_feeds(n_anom_sb, pixels, 0.0), 'n_anomalies')
 
     # number of nans
     where = (mask_sb_sum > 0)
@@ -560,18 +1098,17 @@ def get_scan_stats(filepath, map_grid=None):
     # insert_data_in_array(data, n_nan_sb, 'n_nan')
     
     # tsys averaged over sb
-    insert_data_in_array(data, tsys_sb, 'tsys')
+    insert_data_in_array(data, scatter_feeds(tsys_sb, pixels), 'tsys')
 
     # pca modes 
-    insert_data_in_array(data, ampl[0], 'pca1')
-    insert_data_in_array(data, ampl[1], 'pca2')
-    insert_data_in_array(data, ampl[2], 'pca3')
-    insert_data_in_array(data, ampl[3], 'pca4')
+    insert_data_in_array(data, scatter_feeds(ampl[0], pixels), 'pca1')
+    insert_data_in_array(data, scatter_feeds(ampl[1], pixels), 'pca2')
+    insert_data_in_array(data, scatter_feeds(ampl[2], pixels), 'pca3')
+    insert_data_in_array(data, scatter_feeds(ampl[3], pixels), 'pca4')
 
     # weather statistic
     try:
-        weather  = np.loadtxt(weather_filepath)
-        weather  = weather[np.where(np.isclose(obsid, weather))[0]]
+        weather  = get_weather_rows(obsid)
         ten_min_in_mjd = 1 / 24.0 / 6.0
 
         i_start  = int((mjd[0] - weather[0, 3]) // ten_min_in_mjd)
@@ -588,27 +1125,13 @@ def get_scan_stats(filepath, map_grid=None):
         forecast = np.nan
     insert_data_in_array(data, forecast, 'weather')
 
-    # add kurtosis etc of data histogram
-    kurtosis = np.zeros((n_det, n_sb))
-    skewness = np.zeros((n_det, n_sb))
-
-    for i in range(n_det):
-        for j in range(n_sb):
-            if acc[i,j]:
-                where = np.where(mask[i, j] > 0.0)
-
-                normtod = (tod[i,j]/sigma0[i,j,:,None])[where].flatten()
-                kurtosis[i,j] = stats.kurtosis(normtod)
-                skewness[i,j] = stats.skew(normtod)
-
-    insert_data_in_array(data, kurtosis, 'kurtosis')
-    insert_data_in_array(data, skewness, 'skewness')
-
-    # ps_chi2
+    # ps_chi2, the pointing of missing feeds is taken as zero
     ra = point_radec[:, :, 0]
     dec = point_radec[:, :, 1]
+    ra_first = ra[feed_ind[0]] if feed_ind[0] >= 0 else np.zeros(n_samp)
+    dec_first = dec[feed_ind[0]] if feed_ind[0] >= 0 else np.zeros(n_samp)
 
-    centre = [(np.max(ra[0]) + np.min(ra[0])) / 2, (np.max(dec[0]) + np.min(dec[0])) / 2]
+    centre = [(np.max(ra_first) + np.min(ra_first)) / 2, (np.max(dec_first) + np.min(dec_first)) / 2]
 
     d_dec = 8.0 / 60 
     d_ra = d_dec / np.cos(centre[1] / 180 * np.pi) # arcmin
@@ -620,7 +1143,7 @@ def get_scan_stats(filepath, map_grid=None):
     dec_bins2 = np.linspace(centre[1] - d_dec * n_pix / 2, centre[1] + d_dec * n_pix / 2, n_pix + 1)
 
     if feat == 128:
-        field_centre = [np.mean(ra[0]), np.mean(dec[0])]
+        field_centre = [np.mean(ra_first), np.mean(dec_first)]
         ra_grid = map_grid[0] / np.cos(field_centre[1] * np.pi / 180) + field_centre[0]
         dec_grid = map_grid[1] + field_centre[1]
     else:
@@ -631,14 +1154,20 @@ def get_scan_stats(filepath, map_grid=None):
 
     # map_grid = np.array([ra, dec])
     
+    ra_lim = scatter_feeds(np.array([np.min(ra, axis=1), np.max(ra, axis=1)]).T, pixels, 0.0)
+    dec_lim = scatter_feeds(np.array([np.min(dec, axis=1), np.max(dec, axis=1)]).T, pixels, 0.0)
 
     indices = np.zeros((n_det, 2, 2)).astype(int)
-    ps_chi2 = np.zeros((n_det, n_sb))
-    ps_chi2[:] = np.nan 
+    ps_chi2 = np.zeros((n_det_ind, n_sb))
+    ps_chi2[:] = np.nan
     map_list = [[None for _ in range(n_sb)] for _ in range(n_det)]
+    map_bins = [None for _ in range(n_det_ind)]
+    # the small ps_chi2 grid follows the first feed, so its pixel index is shared by all feeds
+    pix2 = get_pixel_index(ra_first, dec_first, ra_bins2, dec_bins2)
+    rng = get_rng(scanid, 0)
     for i in range(n_det):
-        indices[i, 0, :] = np.digitize((np.min(ra[i]), np.max(ra[i])), ra_grid)
-        indices[i, 1, :] = np.digitize((np.min(dec[i]), np.max(dec[i])), dec_grid)
+        indices[i, 0, :] = np.digitize(ra_lim[i], ra_grid)
+        indices[i, 1, :] = np.digitize(dec_lim[i], dec_grid)
         # prevent overshooting
         indices[i, 0, 0] = max(1, indices[i, 0, 0])
         indices[i, 0, 1] = max(min(len(ra_grid) - 1, indices[i, 0, 1]), indices[i, 0, 0])
@@ -661,21 +1190,74 @@ def get_scan_stats(filepath, map_grid=None):
             print(len(dec_bins))
             print(dec_grid)
             print(len(dec_grid))
-            print(dec[i])
+            print(dec_lim[i])
             # sys.exit(1)
 
-        for j in range(n_sb): ### should not need to be done per sideband.
-            if acc[i, j]:
-                map, nhit = make_map(ra[i], dec[i], ra_bins, dec_bins, tod[i, j], mask[i, j])
+        k = feed_ind[i]
+        if k >= 0:
+            map_bins[k] = (ra_bins, dec_bins)
+
+    # tod based statistics, azimuth binning, kurtosis etc of data histogram and the maps for ps_chi2,
+    # the sums over the tod of one feed are accumulated over one or (in streaming mode) more blocks
+    nbins = 15                                ##### azimuth bins
+    az = point_tel[:, :, 0]
+    full_az_chi2 = np.zeros((n_det_ind, n_sb)) + np.nan
+    max_az_chi2 = np.zeros((n_det_ind, n_sb)) + np.nan
+    med_az_chi2 = np.zeros((n_det_ind, n_sb)) + np.nan
+    kurtosis = np.zeros((n_det_ind, n_sb))
+    skewness = np.zeros((n_det_ind, n_sb))
+    for k in range(n_det_ind):
+        sb_acc = acc[k] != 0
+        if not np.any(sb_acc):
+            continue
+
+        az_ind, az_nhit = get_az_bins(az[k], nbins)
+        az_channels = np.flatnonzero((mask[k] != 0) & sb_acc[:, None])
+        binnings = {'az': (az_ind, nbins, az_channels)}
+        # bin all accepted sidebands and channels of this feed at once
+        mask_acc = mask[k] * sb_acc[:, None]
+        map_channels = np.flatnonzero(mask_acc.flatten() == 1.0)
+        if map_bins[k] is not None:
+            ra_bins, dec_bins = map_bins[k]
+            pix = get_pixel_index(ra[k], dec[k], ra_bins, dec_bins)
+            binnings['map'] = (pix, (len(ra_bins) - 1) * (len(dec_bins) - 1), map_channels)
+            binnings['map2'] = (pix2, n_pix * n_pix, map_channels)
+
+        sums = TodSums(sigma0[k], mask[k], binnings)
+        for start, block in iter_tod_blocks(filepath, k, tod):
+            sums.add(block, start)
+
+        kurt, skew = get_moments(sums.moment_sums)
+        kurtosis[k, sb_acc] = kurt[sb_acc]
+        skewness[k, sb_acc] = skew[sb_acc]
+        full_az_chi2[k, sb_acc], max_az_chi2[k, sb_acc], med_az_chi2[k, sb_acc] = get_az_chi2(
+            sums.bin_sums['az'], az_nhit, sigma0[k], mask[k], sb_acc, az_channels)
+
+        if map_bins[k] is None:
+            continue
+        maps, nhits = get_maps(sums.bin_sums['map'], pix, len(ra_bins) - 1, len(dec_bins) - 1, map_channels, mask_acc.shape)
+        maps2, nhits2 = get_maps(sums.bin_sums['map2'], pix2, n_pix, n_pix, map_channels, mask_acc.shape)
+        for j in range(n_sb):
+            if acc[k, j]:
+                map, nhit = maps[j], nhits[j]
                 where = np.where(nhit > 0)
                 rms = np.zeros_like(nhit)
-                rms[where] = (sigma0[i, j][None, None, :]/ np.sqrt(nhit))[where]
-                #print(np.nanstd((tod[i, j, :, :] / sigma0[i, j, :, None]).flatten()))
+                rms[where] = (sigma0[k, j][None, None, :]/ np.sqrt(nhit))[where]
+                #print(np.nanstd((tod[k, j, :, :] / sigma0[k, j, :, None]).flatten()))
                 #print(np.std(map[where] / rms[where]))
-                map_list[i][j] = [map, rms]
-                ps_chi2[i, j], Pk, ps_mean, ps_std, transfer = get_sb_ps(ra[0], dec[0], ra_bins2, dec_bins2, tod[i, j], mask[i, j], sigma0[i, j], d_dec)
+                map_list[pixels[k]][j] = [map, rms]
+                ps_chi2[k, j], Pk, ps_mean, ps_std, transfer = get_sb_ps(maps2[j], nhits2[j], sigma0[k, j], d_dec, rng=rng)
+    tod = None
+
+    insert_data_in_array(data, scatter_feeds(full_az_chi2, pixels), 'az_chi2')
+    insert_data_in_array(data, scatter_feeds(max_az_chi2, pixels), 'max_az_chi2')
+    insert_data_in_array(data, scatter_feeds(med_az_chi2, pixels), 'med_az_chi2')
+
+    insert_data_in_array(data, scatter_feeds(kurtosis, pixels, 0.0), 'kurtosis')
+    insert_data_in_array(data, scatter_feeds(skewness, pixels, 0.0), 'skewness')
+
     #np.save('ps_chi2_scan', ps_chi2)
-    insert_data_in_array(data, ps_chi2, 'ps_chi2')
+    insert_data_in_array(data, scatter_feeds(ps_chi2, pixels), 'ps_chi2')
     
     # add length of scan
     duration = (mjd[-1] - mjd[0]) * 24 * 60  # in minutes
@@ -689,57 +1271,55 @@ def get_scan_stats(filepath, map_grid=None):
     saddlebags[(2, 7, 8, 9, 10), :] = 4  # feeds 3, 8, 9, 10, 11
     insert_data_in_array(data, saddlebags, 'saddlebag')
     
-    # add one over f of polyfilter components
-    sigma_poly = np.zeros((n_det, n_sb, 2))
-    fknee_poly = np.zeros((n_det, n_sb, 2))
-    alpha_poly = np.zeros((n_det, n_sb, 2))
+    # add one over f of polyfilter components, and of the sideband mean below,
+    # all accepted timestreams of the scan are fitted together
+    sb_acc = acc != 0
+    n_acc = np.sum(sb_acc)
+    noise_tods = np.concatenate((tod_poly[sb_acc].reshape((2 * n_acc, n_samp)), sb_mean[sb_acc]))
+    # in streaming mode in groups of timestreams that fit in the memory limit (the spectra and the
+    # fit take about 64 bytes per sample)
+    n_group = len(noise_tods)
+    if scan_stats_streaming:
+        n_group = max(1, int(scan_stats_memory_limit * 2 ** 20 // (64 * n_samp)))
+    noise_params = np.zeros((3, len(noise_tods)))
+    for start in range(0, len(noise_tods), n_group):
+        noise_params[:, start:start + n_group] = get_noise_params_batch(noise_tods[start:start + n_group], rng=rng)
+    acc_ind = np.argwhere(sb_acc)
+    for k in np.flatnonzero(np.isnan(noise_params[0])):
+        i, j = acc_ind[k // 2] if k < 2 * n_acc else acc_ind[k - 2 * n_acc]
+        print('nan in timestream', scanid, pixels[i], j)
+
+    sigma_poly = np.zeros((n_det_ind, n_sb, 2))
+    fknee_poly = np.zeros((n_det_ind, n_sb, 2))
+    alpha_poly = np.zeros((n_det_ind, n_sb, 2))
     sigma_poly[:] = np.nan
     fknee_poly[:] = np.nan
     alpha_poly[:] = np.nan
-    for i in range(n_det):
-        for j in range(n_sb):
-            if acc[i, j]:
-                for l in range(2):
-                    sigma_poly[i,j,l], fknee_poly[i,j,l], alpha_poly[i,j,l] = get_noise_params(tod_poly[i,j,l])
-                    if np.isinf(sigma_poly[i,j,l]):
-                        pass
-                        # print('unable to fit noise params', scanid, i, j, l)
-                    elif np.isnan(sigma_poly[i,j,l]):
-                        print('nan in timestream', scanid, i, j, l)
-
-    insert_data_in_array(data, sigma_poly[:,:,0], 'sigma_poly0')
-    insert_data_in_array(data, fknee_poly[:,:,0], 'fknee_poly0')
-    insert_data_in_array(data, alpha_poly[:,:,0], 'alpha_poly0')
-    insert_data_in_array(data, sigma_poly[:,:,1], 'sigma_poly1')
-    insert_data_in_array(data, fknee_poly[:,:,1], 'fknee_poly1')
-    insert_data_in_array(data, alpha_poly[:,:,1], 'alpha_poly1')
+    sigma_poly[sb_acc], fknee_poly[sb_acc], alpha_poly[sb_acc] = noise_params[:, :2 * n_acc].reshape((3, n_acc, 2))
+
+    insert_data_in_array(data, scatter_feeds(sigma_poly[:,:,0], pixels), 'sigma_poly0')
+    insert_data_in_array(data, scatter_feeds(fknee_poly[:,:,0], pixels), 'fknee_poly0')
+    insert_data_in_array(data, scatter_feeds(alpha_poly[:,:,0], pixels), 'alpha_poly0')
+    insert_data_in_array(data, scatter_feeds(sigma_poly[:,:,1], pixels), 'sigma_poly1')
+    insert_data_in_array(data, scatter_feeds(fknee_poly[:,:,1], pixels), 'fknee_poly1')
+    insert_data_in_array(data, scatter_feeds(alpha_poly[:,:,1], pixels), 'alpha_poly1')
 
     # sb_mean 
-    power_mean = np.zeros((n_det, n_sb))
-    sigma_mean = np.zeros((n_det, n_sb))
-    fknee_mean = np.zeros((n_det, n_sb))
-    alpha_mean = np.zeros((n_det, n_sb))
+    power_mean = np.zeros((n_det_ind, n_sb))
+    sigma_mean = np.zeros((n_det_ind, n_sb))
+    fknee_mean = np.zeros((n_det_ind, n_sb))
+    alpha_mean = np.zeros((n_det_ind, n_sb))
     power_mean[:] = np.nan
     sigma_mean[:] = np.nan
     fknee_mean[:] = np.nan
     alpha_mean[:] = np.nan
-    for i in range(n_det):
-        for j in range(n_sb):
-            if acc[i, j]:
-                power_mean[i,j] = np.mean(sb_mean[i,j])
-                sigma_mean[i,j], fknee_mean[i,j], alpha_mean[i,j] = get_noise_params(sb_mean[i,j])
-                if np.isinf(sigma_mean[i,j]):
-                    pass
-                    # print('unable to fit noise params', scanid, i, j)
-                elif np.isnan(sigma_mean[i,j]):
-                    print(np.argwhere(np.isnan(sb_mean[i,j])))
-                    print('nan in timestream', scanid, i, j)
-
+    power_mean[sb_acc] = np.mean(sb_mean[sb_acc], axis=1)
+    sigma_mean[sb_acc], fknee_mean[sb_acc], alpha_mean[sb_acc] = noise_params[:, 2 * n_acc:]
 
-    insert_data_in_array(data, power_mean[:,:], 'power_mean')
-    insert_data_in_array(data, sigma_mean[:,:], 'sigma_mean')
-    insert_data_in_array(data, fknee_mean[:,:], 'fknee_mean')
-    insert_data_in_array(data, alpha_mean[:,:], 'alpha_mean')
+    insert_data_in_array(data, scatter_feeds(power_mean, pixels), 'power_mean')
+    insert_data_in_array(data, scatter_feeds(sigma_mean, pixels), 'sigma_mean')
+    insert_data_in_array(data, scatter_feeds(fknee_mean, pixels), 'fknee_mean')
+    insert_data_in_array(data, scatter_feeds(alpha_mean, pixels), 'alpha_mean')
 
     # Housekeeping data
     insert_data_in_array(data, airtemp, 'airtemp')
@@ -755,58 +1335,21 @@ def get_scan_stats(filepath, map_grid=None):
     mean_el = mean_el[:, 0]
     mean_az = mean_az[:, 0]
 
-    moon_dist = np.zeros((n_det, n_sb))
-    moon_angle = np.zeros((n_det, n_sb))
-    moon_central_sl = np.zeros((n_det, n_sb))
-    moon_outer_sl = np.zeros((n_det, n_sb))
+    pole = np.array([mean_el, mean_az])
+    sun_alt, sun_az = get_body_altaz('sun', scan_mjd)
+    moon_alt, moon_az = get_body_altaz('moon', scan_mjd)
+    sun_elevation = np.zeros((n_det, n_sb)) + sun_alt
 
-    sun_dist = np.zeros((n_det, n_sb))
-    sun_angle = np.zeros((n_det, n_sb))
-    sun_central_sl = np.zeros((n_det, n_sb))
-    sun_outer_sl = np.zeros((n_det, n_sb))
+    # distance and angle of the sun and moon from the pointing of every feed, all at once
+    lat, lon = move_to_frame(np.tile(pole, 2), [np.repeat([sun_alt, moon_alt], n_det), np.repeat([sun_az, moon_az], n_det)])
+    dist = np.repeat((90 - lat)[:, None], n_sb, axis=1)
+    angle = np.repeat(lon[:, None], n_sb, axis=1)
+    central_sl, outer_sl = get_sidelobe_flags(dist, angle)
 
-    sun_elevation = np.zeros((n_det, n_sb))
-
-    with solar_system_ephemeris.set('builtin'):
-        loc = coord.EarthLocation(lon=-118.283 * u.deg, lat=37.2313 * u.deg)
-        time = Time(scan_mjd, format='mjd')
-        pole = np.array([mean_el, mean_az])
-        aa = AltAz(location=loc, obstime=time)
-
-        sun = get_body('sun', time, loc)
-        cs = sun.transform_to(aa)
-        sun_elevation[:, :] = cs.alt.deg
-
-        lat, lon = move_to_frame(pole, [cs.alt.deg, cs.az.deg])
-        theta_sun = 90 - lat
-        phi_sun = lon
-
-        sun_dist[:, :] = theta_sun[:, None]
-        sun_angle[:, :] = phi_sun[:, None]
-        sun_angle_mod90 = sun_angle % 90
-        sun_central_sl = 1.0 * (sun_dist < 40) + 1.0 * (sun_dist < 30)
-        cond_1 = (sun_dist > 58.0) * (sun_dist < 75.0) * (sun_angle_mod90 > 75.0)
-        cond_2 = (sun_dist > 58.0) * (sun_dist < 75.0) * (sun_angle_mod90 < 15.0)
-        cond_3 = (sun_dist > 63.0) * (sun_dist < 70.0) * (sun_angle_mod90 > 82.0)
-        cond_4 = (sun_dist > 63.0) * (sun_dist < 70.0) * (sun_angle_mod90 < 8.0)
-        sun_outer_sl = 1.0 * cond_1 + 1.0 * cond_2 + 1.0 * cond_3 + 1.0 * cond_4  # can never be more than 2.0
-
-        moon = get_body('moon', time, loc)
-        cm = moon.transform_to(aa)
-
-        lat, lon = move_to_frame(pole, [cm.alt.deg, cm.az.deg])
-        theta_moon = 90 - lat
-        phi_moon = lon
-        
-        moon_dist[:, :] = theta_moon[:, None]
-        moon_angle[:, :] = phi_moon[:, None]
-        moon_angle_mod90 = moon_angle % 90
-        moon_central_sl = 1.0 * (moon_dist < 40) + 1.0 * (moon_dist < 30)
-        cond_1 = (moon_dist > 58.0) * (moon_dist < 75.0) * (moon_angle_mod90 > 75.0)
-        cond_2 = (moon_dist > 58.0) * (moon_dist < 75.0) * (moon_angle_mod90 < 15.0)
-        cond_3 = (moon_dist > 63.0) * (moon_dist < 70.0) * (moon_angle_mod90 > 82.0)
-        cond_4 = (moon_dist > 63.0) * (moon_dist < 70.0) * (moon_angle_mod90 < 8.0)
-        moon_outer_sl = 1.0 * cond_1 + 1.0 * cond_2 + 1.0 * cond_3 + 1.0 * cond_4  # can never be more than 2.0
+    sun_dist, moon_dist = dist[:n_det], dist[n_det:]
+    sun_angle, moon_angle = angle[:n_det], angle[n_det:]
+    sun_central_sl, moon_central_sl = central_sl[:n_det], central_sl[n_det:]
+    sun_outer_sl, moon_outer_sl = outer_sl[:n_det], outer_sl[n_det:]
 
     insert_data_in_array(data, moon_dist, 'moon_dist')
     insert_data_in_array(data, moon_angle, 'moon_angle')
@@ -821,14 +1364,12 @@ def get_scan_stats(filepath, map_grid=None):
 
     ### perhaps a ps_xy and ps_z to distinguish frequency residuals from angular ones
     
-    filename = '/mn/stornext/d22/cmbco/comap/d16/protodir/sw_complete_' + fieldname + '.h5'
     i_scan = int(str(scanid)[-2:]) - 2  # goes from 0 to n_scan
     #print(scanid, i_scan)
     n_sw = 14
     sw_array = np.zeros((n_det, n_sw, n_sb))
     try:
-        with h5py.File(filename, mode="r") as my_file:
-             sw = my_file['%07i/sw_stats' % obsid][()][:, i_scan]
+        sw = get_sw_stats(fieldname, obsid)[:, i_scan]
         sw_array[:, :, :] = sw[:, :, None]
     except:
         # print('problems with standing waves')
@@ -845,11 +1386,11 @@ def get_scan_stats(filepath, map_grid=None):
     return data, [map_list, indices]
 
 def move_to_frame(ang_cent, ang):
-    # ang = {theta, phi}
+    # ang = {theta, phi}, a single direction or one per frame in ang_cent
     lat = ang[0] * np.pi / 180.0
     lon = ang[1] * np.pi / 180.0
 
-    pos = np.zeros((3))
+    pos = np.zeros((3,) + np.shape(lat))  # one position, or one per frame
     
     pos[0] = np.cos(lat) * np.cos(lon)
     pos[1] = np.cos(lat) * np.sin(lon)
@@ -876,72 +1417,477 @@ def move_to_frame(ang_cent, ang):
 
     return out_ang * 180 / np.pi
 
-def pad_nans(tod):
+def pad_nans(tod, rng=None):
+    # replaces nans (along the last axis) by the mean plus gaussian noise with the std of the
+    # finite samples in a window around them. Gaps longer than the window are filled from their
+    # edges inwards, each pass filling the nans next to finite (or already filled) samples.
     n_pad = 10
-    nan_indices = np.argwhere(np.isnan(tod))
-    
-    for nan_index in nan_indices:
-        start_ind = int(max([nan_index - n_pad, 0]))
-        end_ind = int(min(([nan_index + n_pad, len(tod) - 1])))
-        mean = np.nanmean(tod[start_ind:end_ind])
-        std = np.nanstd(tod[start_ind:end_ind])
-        tod[nan_index] = mean + np.random.randn() * std
-    return tod
-
-
-def get_noise_params(tod, samprate=50.0):
-    tod = tod[:-20]
-    if not np.isfinite(np.mean(tod)):
-        tod = pad_nans(tod)
-    dt = 1 / samprate  # seconds
-
-    n = len(tod)
-    freq = fft.rfftfreq(n, dt)
-    p = np.abs(fft.rfft(tod)) ** 2 / (n)
-    bins = np.logspace(-2, 1, 20)
-    nmodes = np.histogram(freq, bins=bins)[0]
-    bin_freqs = np.histogram(freq, bins=bins, weights=freq)[0] / nmodes
-    ps = np.histogram(freq, bins=bins, weights=p)[0] / nmodes
-
-    sigma0 = np.std(tod[1:] - tod[:-1]) / np.sqrt(2)
-
-    def one_over_f(freq, alpha, fknee):
-        return sigma0 ** 2 * (1.0 + (freq / fknee) ** alpha)
-
-    try: 
-        p0 = (-2, 5)
-        
-        popt, pcov = curve_fit(one_over_f, bin_freqs, ps, p0=p0, sigma=ps/np.sqrt(nmodes))
-        alpha = popt[0]
-        fknee = popt[1]
-    except:
-        try:
-            a = -1  # solve for alpha
-            p0 = (a, 10)
-            
-            popt, pcov = curve_fit(one_over_f, bin_freqs, ps, p0=p0, sigma=ps/np.sqrt(nmodes))
-            alpha = popt[0]
-            fknee = popt[1]
-        except: 
-            return np.inf, np.inf, np.inf
-    #     print('unable to fit noise parameters')
-    #     print(ps)
-    #     # return np.nan, np.nan, np.nan
-    #     p0 = (-1, 10)
-    #     plt.loglog(freq, p)
-    #     plt.loglog(freq, sigma0 ** 2 + 0.0 * freq)
-    #     plt.loglog(bin_freqs, ps) 
-    #     plt.loglog(bin_freqs, one_over_f(bin_freqs, *p0), 'g--', label='fit: alpha=%5.3f, fknee=%5.3f' % tuple(p0))
-    #     plt.show()
-    #     popt, pcov = curve_fit(one_over_f, bin_freqs, ps, p0=p0, sigma=ps/np.sqrt(nmodes))
-    #     sys.exit()
-    #     # 
+    if rng is None:
+        rng = np.random.default_rng()
+    n = tod.shape[-1]
+    while True:
+        finite = np.isfinite(tod)
+        nan_indices = np.nonzero(~finite)
+        if len(nan_indices[-1]) == 0:
+            return tod
+
+        values = np.where(finite, tod, 0.0)
+        cumsums = [np.zeros(tod.shape[:-1] + (n + 1,)) for _ in range(3)]
+        for cumsum, x in zip(cumsums, (finite * 1.0, values, values ** 2)):
+            np.cumsum(x, axis=-1, out=cumsum[..., 1:])
+        start_ind = np.maximum(nan_indices[-1] - n_pad, 0)
+        end_ind = np.minimum(nan_indices[-1] + n_pad, n - 1)
+        rows = nan_indices[:-1]
+        count, total, total_sq = [cumsum[rows + (end_ind,)] - cumsum[rows + (start_ind,)] for cumsum in cumsums]
+        filled = count > 0
+        if not np.any(filled):
+            return tod  # nothing finite left to fill from
+        count, total, total_sq = count[filled], total[filled], total_sq[filled]
+        mean = total / count
+        std = np.sqrt(np.maximum(total_sq / count - mean ** 2, 0))
+        tod[tuple(index[filled] for index in nan_indices)] = mean + rng.standard_normal(len(mean)) * std
+
+
+# fit of the noise parameters, 'curve_fit' (one timestream at a time, as the fit always was) or 'lm'
+# (batched Levenberg-Marquardt over all timestreams, falling back to curve_fit where it does not converge),
+# set from NOISE_FIT_METHOD in the parameter file. 'lm' is faster, but does not reproduce curve_fit exactly
+# on poorly constrained spectra, so only use it for tests.
+noise_fit_method = 'curve_fit'
+noise_fit_bins = {}  # log-frequency binning of the periodograms, one per number of samples
+
+
+def get_noise_fit_bins(n, samprate):
+    key = (n, samprate)
+    if key not in noise_fit_bins:
+        freq = fft.rfftfreq(n, 1 / samprate)
+        bins = np.logspace(-2, 1, 20)
+        ind = get_bin_index(freq, bins)
+        keep = np.flatnonzero(ind >= 0)
+        nmodes = np.bincount(ind[keep], minlength=len(bins) - 1)
+        with np.errstate(invalid='ignore', divide='ignore'):
+            bin_freqs = np.bincount(ind[keep], weights=freq[keep], minlength=len(bins) - 1) / nmodes
+        noise_fit_bins[key] = (keep, ind[keep], nmodes, bin_freqs)
+    return noise_fit_bins[key]
+
+
+def fit_one_over_f(bin_freqs, ps, nmodes, sigma0, p0, n_iter=200, tol=1.49012e-08, alpha_max=50.0):
+    # Weighted least squares fit of sigma0^2 (1 + (f / fknee)^alpha) to the binned spectra ps (n_tod, n_bins),
+    # with errors ps / sqrt(nmodes) as in curve_fit, for all timestreams at once. Levenberg-Marquardt in
+    # (alpha, ln fknee), which keeps fknee positive. Returns alpha, fknee and whether the fit converged.
+    # Spectra without 1/f noise have no minimum (fknee -> 0, alpha -> -inf), these count as failed.
+    n_tod = ps.shape[0]
+    log_f = np.log(bin_freqs)[None, :]
+    s2 = sigma0[:, None] ** 2
+    sw = np.sqrt(nmodes)[None, :] / ps
+    alpha = np.full(n_tod, float(p0[0]))
+    log_fknee = np.full(n_tod, np.log(p0[1]))
+    lam = np.full(n_tod, 1e-3)
+    converged = np.zeros(n_tod, dtype=bool)
+
+    def residuals(alpha, log_fknee):
+        e = np.exp(alpha[:, None] * (log_f - log_fknee[:, None]))
+        r = sw * (s2 * (1.0 + e) - ps)
+        return e, r, np.sum(r ** 2, axis=1)
+
+    with np.errstate(all='ignore'):
+        e, r, cost = residuals(alpha, log_fknee)
+        active = np.isfinite(cost)
+        for _ in range(n_iter):
+            if not np.any(active):
+                break
+            j_alpha = sw * s2 * e * (log_f - log_fknee[:, None])
+            j_fknee = -sw * s2 * e * alpha[:, None]
+            a11 = np.sum(j_alpha ** 2, axis=1)
+            a22 = np.sum(j_fknee ** 2, axis=1)
+            a12 = np.sum(j_alpha * j_fknee, axis=1)
+            g1 = np.sum(j_alpha * r, axis=1)
+            g2 = np.sum(j_fknee * r, axis=1)
+            d11 = a11 * (1 + lam)
+            d22 = a22 * (1 + lam)
+            det = d11 * d22 - a12 ** 2
+            step_alpha = -(d22 * g1 - a12 * g2) / det
+            step_fknee = -(d11 * g2 - a12 * g1) / det
+
+            new_alpha = np.where(active, alpha + step_alpha, alpha)
+            new_log_fknee = np.where(active, log_fknee + step_fknee, log_fknee)
+            new_e, new_r, new_cost = residuals(new_alpha, new_log_fknee)
+            better = active & np.isfinite(new_cost) & (new_cost <= cost)
+            done = better & (cost - new_cost <= tol * np.maximum(new_cost, tol))
+
+            alpha[better] = new_alpha[better]
+            log_fknee[better] = new_log_fknee[better]
+            e[better] = new_e[better]
+            r[better] = new_r[better]
+            cost[better] = new_cost[better]
+            lam = np.where(better, lam * 0.3, lam * 10)
+            converged |= done
+            active &= ~done & (lam < 1e12)
+    converged &= np.isfinite(log_fknee) & (np.abs(alpha) < alpha_max)
+    return alpha, np.exp(log_fknee), converged
+
+
+def fit_one_over_f_curve_fit(bin_freqs, ps, nmodes, sigma0):
+    # the same fit as fit_one_over_f, one timestream at a time with curve_fit in (alpha, fknee), from the
+    # start point (-2, 5) and else (-1, 10). Returns alpha and fknee, inf where both fail.
+    alpha = np.full(len(ps), np.inf)
+    fknee = np.full(len(ps), np.inf)
+    for k in range(len(ps)):
+        def one_over_f(freq, alpha, fknee):
+            return sigma0[k] ** 2 * (1.0 + (freq / fknee) ** alpha)
+
+        for p0 in [(-2, 5), (-1, 10)]:
+            try:
+                with warnings.catch_warnings(), np.errstate(all='ignore'):
+                    warnings.simplefilter('ignore')
+                    popt, _ = curve_fit(one_over_f, bin_freqs, ps[k], p0=p0, sigma=ps[k] / np.sqrt(nmodes))
+            except Exception:
+                continue
+            alpha[k], fknee[k] = popt
+            break
+    return alpha, fknee
+
+
+def get_noise_params_batch(tods, samprate=50.0, rng=None):
+    # sigma0, fknee and alpha of a stack of timestreams (n_tod, n_samp), inf where the fit fails
+    tods = np.array(tods, dtype=np.float64)[:, :-20]
+    n_tod, n = tods.shape
+    if not np.all(np.isfinite(tods)):
+        tods = pad_nans(tods, rng)
+
+    keep, ind, nmodes, bin_freqs = get_noise_fit_bins(n, samprate)
+    n_bins = len(nmodes)
+    p = np.abs(fft.rfft(tods, axis=1)) ** 2 / n
+    ind = (ind[None, :] + n_bins * np.arange(n_tod)[:, None]).ravel()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        ps = np.bincount(ind, weights=p[:, keep].ravel(), minlength=n_tod * n_bins).reshape((n_tod, n_bins)) / nmodes
+
+    sigma0 = np.std(tods[:, 1:] - tods[:, :-1], axis=1) / np.sqrt(2)
+
+    if noise_fit_method == 'curve_fit':
+        alpha, fknee = fit_one_over_f_curve_fit(bin_freqs, ps, nmodes, sigma0)
+    else:
+        fknee = np.full(n_tod, np.inf)
+        alpha = np.full(n_tod, np.inf)
+        # curve_fit refuses non-finite data and zero errors, in which case the fit fails
+        fit = np.all(np.isfinite(ps), axis=1) & np.all(ps > 0, axis=1) & np.isfinite(sigma0) & np.all(nmodes > 0)
+        for p0 in [(-2, 5), (-1, 10)]:
+            if not np.any(fit):
+                break
+            rows = np.flatnonzero(fit)
+            alpha_fit, fknee_fit, converged = fit_one_over_f(bin_freqs, ps[rows], nmodes, sigma0[rows], p0)
+            rows = rows[converged]
+            alpha[rows] = alpha_fit[converged]
+            fknee[rows] = fknee_fit[converged]
+            fit[rows] = False
+        # timestreams where the batched fit did not converge get curve_fit
+        rows = np.flatnonzero(fit)
+        if len(rows) > 0:
+            alpha[rows], fknee[rows] = fit_one_over_f_curve_fit(bin_freqs, ps[rows], nmodes, sigma0[rows])
+    sigma0[~np.isfinite(fknee)] = np.inf
     return sigma0, fknee, alpha
 
+
+def get_noise_params(tod, samprate=50.0, rng=None):
+    sigma0, fknee, alpha = get_noise_params_batch(tod[None, :], samprate, rng)
+    return sigma0[0], fknee[0], alpha[0]
+
+def get_stats_version(stat):
+    # version tag of a statistic in the cache, the ps statistics also depend on the noise spectrum
+    tag = stats_versions.get(stat, '1')
+    if stat.startswith('ps_'):
+        tag += '-' + ps_noise_mode
+        if ps_noise_mode == 'mc':
+            tag += '-%i-%i' % (n_sim_ps, ps_sim_seed)
+    return tag
+
+
+def get_file_keys(filepaths):
+    # size and modification time of every level2 file, cached statistics are valid while these match
+    keys = np.zeros((len(filepaths), 2), dtype=np.int64)
+    for i, filepath in enumerate(filepaths):
+        try:
+            stat = os.stat(filepath)
+            keys[i] = stat.st_size, stat.st_mtime_ns
+        except OSError:
+            keys[i] = -1
+    return keys
+
+
+def get_stats_cache_path(fieldname, obsid, cache_dir):
+    return os.path.join(cache_dir, fieldname, '%s.h5' % obsid)
+
+
+def read_stats_cache(fieldname, obsid, filepaths, file_keys, cache_dir=None, partial=False):
+    # cached scan_data (n_scans, 20, 4, n_stats) of an obsid and the statistics missing from it, (None, None)
+    # if there is none or if any of its level2 files changed. The cache is per obsid, as the obsid level ps
+    # statistics depend on all its scans. If partial, a cache that only misses (or has outdated) ps_stats
+    # is returned with these statistics missing, they can be recomputed from the map cache (see
+    # fill_cached_ps_stats). Otherwise the obsid is recomputed as a whole, get_scan_stats computes all
+    # statistics from one read of the tod, so there is little to gain by recomputing single columns.
+    # cache_dir defaults to scan_stats_cache_dir.
+    if cache_dir is None:
+        cache_dir = scan_stats_cache_dir
+    if cache_dir is None:
+        return None, None
+    filename = get_stats_cache_path(fieldname, obsid, cache_dir)
+    if not os.path.exists(filename):
+        return None, None
+    try:
+        with h5py.File(filename, mode="r") as my_file:
+            if list(my_file['filepaths'].asstr()[()]) != list(filepaths):
+                return None, None
+            if not np.array_equal(my_file['file_keys'][()], file_keys):
+                return None, None
+            cached_stats = list(my_file['stats'].asstr()[()])
+            versions = list(my_file['versions'].asstr()[()])
+            columns = {stat: i for i, stat in enumerate(cached_stats)}
+            missing = [stat for stat in stats_list if stat not in columns or versions[columns[stat]] != get_stats_version(stat)]
+            if len(missing) > 0 and (not partial or map_cache_dir is None or not set(missing) <= set(ps_stats)):
+                return None, None
+            cached_data = my_file['scan_data'][()]
+    except (OSError, KeyError):
+        print('Could not read cached statistics', filename)
+        return None, None
+    data = np.zeros(cached_data.shape[:-1] + (len(stats_list),), dtype=np.float32)
+    for k, stat in enumerate(stats_list):
+        if stat not in missing:
+            data[..., k] = cached_data[..., columns[stat]]
+    return data, missing
+
+
+def write_stats_cache(fieldname, obsid, filepaths, file_keys, scan_data, cache_dir=None):
+    if cache_dir is None:
+        cache_dir = scan_stats_cache_dir
+    if cache_dir is None:
+        return
+    filename = get_stats_cache_path(fieldname, obsid, cache_dir)
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + '.%i.tmp' % os.getpid()
+    with h5py.File(tmp_filename, mode="w") as my_file:
+        my_file.create_dataset('filepaths', data=np.array(filepaths, dtype='S'))
+        my_file.create_dataset('file_keys', data=file_keys)
+        my_file.create_dataset('stats', data=np.array(stats_list, dtype='S'))
+        my_file.create_dataset('versions', data=np.array([get_stats_version(stat) for stat in stats_list], dtype='S'))
+        my_file.create_dataset('scan_data', data=scan_data)
+    os.replace(tmp_filename, filename)  # readers never see a partly written file
+
+
+def get_map_cache_path(fieldname, obsid):
+    return os.path.join(map_cache_dir, fieldname, '%s.h5' % obsid)
+
+
+def write_map_cache(fieldname, scans, maps, map_grid, file_keys):
+    # maps ([map_list, indices] of every scan, see get_scan_stats) of the obsid of scans, made from the
+    # level2 files with the get_file_keys file_keys. A feed of a scan has one map and rms
+    # (n_sb, n_ra, n_dec, 64), zero on the sidebands that are not accepted.
+    if map_cache_dir is None or len(scans) == 0:
+        return
+    filename = get_map_cache_path(fieldname, scans[0][:-2])
+    os.makedirs(os.path.dirname(filename), exist_ok=True)
+    tmp_filename = filename + '.%i.tmp' % os.getpid()
+    with h5py.File(tmp_filename, mode="w") as my_file:
+        my_file.create_dataset('scans', data=np.array(scans, dtype='S'))
+        my_file.create_dataset('map_grid', data=map_grid)
+        my_file.create_dataset('file_keys', data=file_keys)
+        for scanid, (map_list, indices) in zip(scans, maps):
+            scan_group = my_file.create_group(scanid)
+            scan_group.create_dataset('indices', data=indices)
+            for i, sb_maps in enumerate(map_list):
+                accepted = [sb_map is not None for sb_map in sb_maps]
+                if not any(accepted):
+                    continue
+                shape = next(sb_map[0].shape for sb_map in sb_maps if sb_map is not None)
+                map = np.zeros((len(sb_maps),) + shape, dtype=np.float32)
+                rms = np.zeros_like(map)
+                for j, sb_map in enumerate(sb_maps):
+                    if sb_map is not None:
+                        map[j], rms[j] = sb_map
+                feed_group = scan_group.create_group('feed%02i' % i)
+                feed_group.create_dataset('accepted', data=accepted)
+                feed_group.create_dataset('map', data=map, **h5_compression)
+                feed_group.create_dataset('rms', data=rms, **h5_compression)
+    os.replace(tmp_filename, filename)
+
+
+def read_map_cache(fieldname, scans, map_grid, file_keys):
+    # cached maps of the obsid of scans, as given to get_power_spectra, or None if there are none for
+    # these scans and this map grid, or if any of their level2 files changed (file_keys as in get_file_keys)
+    if map_cache_dir is None or len(scans) == 0:
+        return None
+    filename = get_map_cache_path(fieldname, scans[0][:-2])
+    if not os.path.exists(filename):
+        return None
+    try:
+        with h5py.File(filename, mode="r") as my_file:
+            if list(my_file['scans'].asstr()[()]) != list(scans):
+                return None
+            if not np.array_equal(my_file['map_grid'][()], map_grid):
+                return None
+            if 'file_keys' not in my_file or not np.array_equal(my_file['file_keys'][()], file_keys):
+                return None
+            maps = []
+            for scanid in scans:
+                scan_group = my_file[scanid]
+                indices = scan_group['indices'][()]
+                map_list = [[None for _ in range(4)] for _ in range(20)]
+                for i in range(20):
+                    if 'feed%02i' % i not in scan_group:
+                        continue
+                    feed_group = scan_group['feed%02i' % i]
+                    map = np.asarray(feed_group['map'][()], dtype=np.float64)
+                    rms = np.asarray(feed_group['rms'][()], dtype=np.float64)
+                    for j in np.flatnonzero(feed_group['accepted'][()]):
+                        map_list[i][j] = [map[j], rms[j]]
+                maps.append([map_list, indices])
+            return maps
+    except (OSError, KeyError):
+        print('Could not read cached maps', filename)
+        return None
+
+
 class ObsidData():
     def __init__(self):
         pass
 
+def set_task_starts(queue):
+    global task_starts
+    task_starts = queue
+
+
+def get_pool():
+    global pool, pool_size
+    if pool is None:
+        pool_size = n_workers
+        if pool_size is None:
+            pool_size = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+        set_task_starts(multiprocessing.SimpleQueue())
+        pool = multiprocessing.Pool(pool_size, initializer=set_task_starts, initargs=(task_starts,))
+    return pool
+
+
+def close_pool(terminate=False):
+    # waits for the workers to finish, or stops them at once if terminate (after an error)
+    global pool
+    if pool is not None:
+        if terminate:
+            pool.terminate()
+        else:
+            pool.close()
+        pool.join()
+        pool = None
+
+
+def run_task(args):
+    # func(func_args) in a worker of the pool, after telling the parent that task task_id started there
+    task_id, func, func_args = args
+    task_starts.put((os.getpid(), task_id))
+    return task_id, func(func_args)
+
+
+class PoolTasks():
+    # Tasks func(args) run in the pool (see get_pool), get returns their results as they finish. The
+    # workers report the tasks they start (run_task), so the parent finds the tasks whose worker died
+    # and the scans that run longer than scan_timeout seconds, neither of which the pool ever returns. The
+    # pool is then recreated, the other tasks are resubmitted and the lost ones are retried, up to
+    # scan_retries times. A scan that is still lost gets the statistics of a failed scan.
+    def __init__(self):
+        self.results = queue.Queue()
+        self.running = {}  # task id: (func, args, attempt)
+        self.started = {}  # task id: (worker pid, start time)
+        self.n_tasks = 0
+        self.last_check = time.time()
+
+    def __len__(self):
+        return len(self.running)
+
+    def submit(self, func, args, attempt=0):
+        task_id = self.n_tasks
+        self.n_tasks += 1
+        self.running[task_id] = (func, args, attempt)
+        get_pool().apply_async(run_task, ((task_id, func, args),), callback=self.results.put, error_callback=self.results.put)
+        return task_id
+
+    def get(self):
+        while True:
+            try:
+                result = self.results.get(timeout=1.0)
+            except queue.Empty:
+                result = None
+            if isinstance(result, BaseException):
+                raise result
+            if result is not None and result[0] in self.running:
+                del self.running[result[0]]
+                self.started.pop(result[0], None)
+            else:
+                result = None  # none yet, or from a pool that was recreated since
+            if time.time() - self.last_check >= 1.0:
+                self.check()
+            if result is not None:
+                return result[1]
+
+    def check(self):
+        now = time.time()
+        self.last_check = now
+        while not task_starts.empty():
+            pid, task_id = task_starts.get()
+            if task_id in self.running:
+                self.started[task_id] = (pid, now)
+        workers = set(process.pid for process in multiprocessing.active_children())
+        lost = {}
+        for task_id, (pid, start) in self.started.items():
+            if pid not in workers:
+                lost[task_id] = 'WorkerLost: worker %i died' % pid
+            elif scan_timeout > 0 and self.running[task_id][0] is get_scan_result and now - start > scan_timeout:
+                lost[task_id] = 'ScanTimeout: no result after %i s' % scan_timeout
+        if len(lost) == 0:
+            return
+        close_pool(terminate=True)
+        lost = [self.running.pop(task_id) + (error,) for task_id, error in lost.items()]
+        running = list(self.running.values())
+        self.running = {}
+        self.started = {}
+        for func, args, attempt in running:
+            self.submit(func, args, attempt)
+        for func, args, attempt, error in lost:
+            print('Lost', func.__name__, 'of', args[2] if func is get_scan_result else 'obsid %i' % args[0], '(attempt %i):' % (attempt + 1), error)
+            if attempt < scan_retries:
+                if func is get_scan_result:
+                    args = args[:-1] + (attempt + 1,)
+                self.submit(func, args, attempt + 1)
+            elif func is get_scan_result:
+                i, j, filepath, fieldname, scanid, _ = args
+                data, maps = get_failed_scan_stats(scanid)
+                task_id = self.n_tasks
+                self.n_tasks += 1
+                self.running[task_id] = (func, args, attempt)
+                self.results.put((task_id, ('scan', i, j, data, maps, error)))
+            else:
+                raise RuntimeError('%s of obsid %i failed: %s' % (func.__name__, args[0], error))
+
+
+def get_scan_cost(filepath):
+    # estimated cost of a scan, the number of tod samples (file size if unreadable)
+    try:
+        with h5py.File(filepath, mode="r") as my_file:
+            return np.prod(my_file['tod'].shape, dtype=np.int64)
+    except (OSError, KeyError):
+        return os.path.getsize(filepath) if os.path.exists(filepath) else 0
+
+
+def get_obsid_rows(obsid_info):
+    # rows of the obsid in the scan_data of its field
+    return slice(obsid_info.offset, obsid_info.offset + len(obsid_info.scans))
+
+
+def write_checkpoint(fieldname, obsid_infos, scan_data, to_checkpoint):
+    # writes the obsids to_checkpoint (indices into obsid_infos) to the checkpoint and empties the list
+    if checkpoint_dir is not None and scan_stats_cache_dir is None:
+        for i in to_checkpoint:
+            obsid_info = obsid_infos[i]
+            write_stats_cache(fieldname, obsid_info.scans[0][:-2], obsid_info.filepaths, obsid_info.file_keys, scan_data[get_obsid_rows(obsid_info)], checkpoint_dir)
+    to_checkpoint.clear()
+
+
 def get_scan_data(params, fields, fieldname, paralellize=True):
     l2_path = params['LEVEL2_DIR']
     field = fields[fieldname]
@@ -953,11 +1899,22 @@ def get_scan_data(params, fields, fieldname, paralellize=True):
     scan_list = np.zeros((n_scans), dtype=np.int32)
     scan_data = np.zeros((n_scans, n_feeds, n_sb, n_stats), dtype=np.float32)
  
-    if paralellize:
-        pool = multiprocessing.Pool(128)
+    # read the auxiliary data once, the workers of the pool inherit it
+    get_weather_table()
+    get_sw_table(fieldname)
 
+    if paralellize:
+        # scan stage: get_scan_stats of every scan, dispatched individually, obsid by obsid with the most
+        # expensive obsids first and the scans of an obsid together, most expensive first,
+        # obsid stage: reduce_obsid of an obsid as soon as all of its scans are done. Cached obsids
+        # are read here, obsids whose cache only misses ps_stats are reduced from their cached maps first
+        # (fill_cached_ps_stats). Only a few tasks are queued at a time, so reductions start right away.
+        # All results are written into scan_data at the rows of their obsid as they arrive, only the
+        # maps of the obsids in progress, about n_max_running of them, are kept until their reduction.
         i_scan = 0
         obsid_infos = []
+        todo = []
+        ps_tasks = collections.deque()  # obsids with cached statistics that only miss ps_stats
         for obsid in field[0]:
             scans = field[1][obsid]
             n_scans = len(scans)
@@ -965,19 +1922,88 @@ def get_scan_data(params, fields, fieldname, paralellize=True):
             obsid_info.scans = scans
             obsid_info.field = fieldname
             obsid_info.l2_path = l2_path
-            obsid_infos.append(obsid_info)
+            obsid_info.filepaths = get_obsid_filepaths(obsid_info)
+            obsid_info.file_keys = get_file_keys(obsid_info.filepaths)
+            obsid_info.offset = i_scan
             scan_list[i_scan:i_scan+n_scans] = scans
             i_scan += n_scans
-        scan_data_list = list(tqdm(pool.imap(get_obsid_data, obsid_infos, chunksize=1), total=len(obsid_infos)))
+            if n_scans == 0:
+                continue
+            data, missing = read_stats_cache(fieldname, scans[0][:-2], obsid_info.filepaths, obsid_info.file_keys, partial=True)
+            # obsids of an interrupted run
+            if data is None and checkpoint_dir is not None and scan_stats_cache_dir is None:
+                data, missing = read_stats_cache(fieldname, scans[0][:-2], obsid_info.filepaths, obsid_info.file_keys, checkpoint_dir, True)
+            if data is None:
+                todo.append(len(obsid_infos))
+            elif len(missing) > 0:
+                ps_tasks.append((len(obsid_infos), data, fieldname, scans, obsid_info.file_keys, missing))
+            else:
+                scan_data[get_obsid_rows(obsid_info)] = data
+            obsid_infos.append(obsid_info)
+
+        def get_scan_tasks(i):
+            return [(i, j, filepath, fieldname, obsid_infos[i].scans[j], 0) for j, filepath in enumerate(obsid_infos[i].filepaths)]
+
+        tasks = [task for i in todo for task in get_scan_tasks(i)]
+        pool = get_pool()
+        costs = pool.map(get_scan_cost, [task[2] for task in tasks], chunksize=16)
+        obsid_costs = collections.Counter()
+        for task, cost in zip(tasks, costs):
+            obsid_costs[task[0]] += cost
+        order = sorted(range(len(tasks)), key=lambda k: (-obsid_costs[tasks[k][0]], tasks[k][0], -costs[k], k))
+        tasks = collections.deque([tasks[k] for k in order])
+
+        obsid_maps = {i: [None] * len(obsid_infos[i].scans) for i in todo}
+        n_scans_left = {i: len(obsid_infos[i].scans) for i in todo}
+        failed = set()
+        to_checkpoint = []
+        last_checkpoint = time.time()
+        running = PoolTasks()
+        n_max_running = 2 * pool_size
+        progress = tqdm(total=len(tasks))
+        try:
+            while len(tasks) > 0 or len(ps_tasks) > 0 or len(running) > 0:
+                while len(ps_tasks) > 0 and len(running) < n_max_running:
+                    running.submit(fill_cached_ps_stats, ps_tasks.popleft())
+                while len(tasks) > 0 and len(running) < n_max_running:
+                    running.submit(get_scan_result, tasks.popleft())
+                result = running.get()
+                if result[0] == 'scan':
+                    _, i, j, data, maps, error = result
+                    scan_data[obsid_infos[i].offset + j] = data
+                    obsid_maps[i][j] = maps
+                    n_scans_left[i] -= 1
+                    progress.update(1)
+                    if error is not None:
+                        scan_errors.setdefault(fieldname, {})[obsid_infos[i].scans[j]] = error
+                        failed.add(i)
+                    if n_scans_left[i] == 0:
+                        args = (i, scan_data[get_obsid_rows(obsid_infos[i])], obsid_maps.pop(i), fieldname, obsid_infos[i].scans, obsid_infos[i].file_keys, i not in failed)
+                        running.submit(reduce_obsid, args)
+                elif result[2] is None:
+                    # the maps of an obsid with missing ps_stats are not cached, all its scans are recomputed
+                    i = result[1]
+                    obsid_maps[i] = [None] * len(obsid_infos[i].scans)
+                    n_scans_left[i] = len(obsid_infos[i].scans)
+                    tasks.extend(get_scan_tasks(i))
+                    progress.total += len(obsid_infos[i].scans)
+                    progress.refresh()
+                else:
+                    _, i, data = result
+                    obsid_info = obsid_infos[i]
+                    scan_data[get_obsid_rows(obsid_info)] = data
+                    if i not in failed:  # obsids with failed scans are recomputed in the next run
+                        write_stats_cache(fieldname, obsid_info.scans[0][:-2], obsid_info.filepaths, obsid_info.file_keys, data)
+                        to_checkpoint.append(i)
+                if time.time() - last_checkpoint > checkpoint_interval:
+                    write_checkpoint(fieldname, obsid_infos, scan_data, to_checkpoint)
+                    last_checkpoint = time.time()
+        finally:
+            write_checkpoint(fieldname, obsid_infos, scan_data, to_checkpoint)
+        progress.close()
         print('Done with parallell')
-        i = 0
-        i_scan = 0
-        for obsid in field[0]:
-            scans = field[1][obsid]
-            n_scans = len(scans)
-            scan_data[i_scan:i_scan+n_scans] = scan_data_list[i]
-            i_scan += n_scans
-            i += 1
+        if checkpoint_dir is not None:
+            shutil.rmtree(os.path.join(checkpoint_dir, fieldname), ignore_errors=True)
         
         # scanids = [scanid for obsid in field[0] for scanid in field[1][obsid]]
 
@@ -1010,11 +2036,7 @@ def get_scan_data(params, fields, fieldname, paralellize=True):
     return scan_list, scan_data
 
 
-def get_obsid_data(obsid_info):
-    scans = obsid_info.scans
-    fieldname = obsid_info.field
-    l2_path = obsid_info.l2_path
-    
+def get_map_grid(fieldname):
     ## set up map grid
     info = patch_info[fieldname]
     if fieldname == "NCP":
@@ -1030,33 +2052,112 @@ def get_obsid_data(obsid_info):
 
     map_grid = np.array([ra, dec])
     # print(map_grid)
+    return map_grid
+
+
+def get_obsid_filepaths(obsid_info):
+    l2_path = obsid_info.l2_path
+    fieldname = obsid_info.field
+    return [l2_path + '/' + fieldname + '/' + fieldname + '_0' + scanid + '.h5' for scanid in obsid_info.scans]
+    #return [l2_path + '/' + fieldname + '_0' + scanid + '.h5' for scanid in obsid_info.scans]
+
+
+def get_failed_scan_stats(scanid):
+    # nan statistics and no maps of a scan that could not be processed, indices as for a missing feed
+    data = np.zeros((20, 4, len(stats_list)), dtype=np.float32)
+    data[:] = np.nan
+    insert_data_in_array(data, int(scanid[:-2]), 'obsid')
+    insert_data_in_array(data, int(scanid), 'scanid')
+    indices = np.ones((20, 2, 2)).astype(int)
+    map_list = [[None for _ in range(4)] for _ in range(20)]
+    return data, [map_list, indices]
+
+
+def get_scan_result(args):
+    # scan stage, the statistics and binned maps of scan j of obsid i, from attempt first_attempt on
+    # (earlier ones were lost, see PoolTasks). Errors are caught, so a bad scan only gives a nan row and
+    # the error (None if the scan succeeded)
+    i, j, filepath, fieldname, scanid, first_attempt = args
+    for attempt in range(first_attempt, 1 + scan_retries):
+        try:
+            data, maps = get_scan_stats(filepath, get_map_grid(fieldname), fieldname)
+            return 'scan', i, j, data, maps, None
+        except Exception as e:
+            error = '%s: %s' % (type(e).__name__, e)
+            print('Could not process', filepath, '(attempt %i):' % (attempt + 1), error)
+    data, maps = get_failed_scan_stats(scanid)
+    return 'scan', i, j, data, maps, error
+
+
+def reduce_obsid(args):
+    # obsid stage, the ps statistics of obsid i from the maps of all its scans, added to its scan_data.
+    # The maps are cached (see write_map_cache) if all scans succeeded (complete).
+    i, scan_data, maps, fieldname, scans, file_keys, complete = args
+    map_grid = get_map_grid(fieldname)
+    if complete:
+        write_map_cache(fieldname, scans, maps, map_grid, file_keys)
+    for stat_string, ps_stat in zip(ps_stats, get_power_spectra(maps, map_grid, scans)):
+        insert_data_in_array(scan_data, ps_stat, stat_string, obsid=True)
+    return 'obsid', i, scan_data
+
+
+def get_cached_ps_stats(args):
+    # ps_stats (n_scans, 20, 4) of the scans of an obsid from its cached maps, None if they are not cached
+    # or are outdated (file_keys of the level2 files of the scans, see get_file_keys)
+    fieldname, scans, file_keys = args
+    map_grid = get_map_grid(fieldname)
+    maps = read_map_cache(fieldname, scans, map_grid, file_keys)
+    if maps is None:
+        return None
+    return get_power_spectra(maps, map_grid, scans)
+
+
+def fill_cached_ps_stats(args):
+    # obsid stage of obsid i whose cached scan_data only misses the ps_stats in missing (see
+    # read_stats_cache), these are recomputed from the cached maps. None as scan_data if they are not cached.
+    i, scan_data, fieldname, scans, file_keys, missing = args
+    ps = get_cached_ps_stats((fieldname, scans, file_keys))
+    if ps is None:
+        return 'obsid', i, None
+    for stat_string, ps_stat in zip(ps_stats, ps):
+        if stat_string in missing:
+            insert_data_in_array(scan_data, ps_stat, stat_string, obsid=True)
+    return 'obsid', i, scan_data
+
+
+def get_obsid_data(obsid_info):
+    # both stages of one obsid in this process
+    scans = obsid_info.scans
+    fieldname = obsid_info.field
 
     n_scans = len(scans)
     n_stats = len(stats_list)
     n_feeds = 20
     n_sb = 4
+    filepaths = get_obsid_filepaths(obsid_info)
+    obsid = scans[0][:-2] if n_scans > 0 else None
+    file_keys = get_file_keys(filepaths)
+    scan_data, missing = read_stats_cache(fieldname, obsid, filepaths, file_keys, partial=True)
+    if scan_data is not None and len(missing) > 0:
+        scan_data = fill_cached_ps_stats((0, scan_data, fieldname, scans, file_keys, missing))[2]
+        if scan_data is not None:
+            write_stats_cache(fieldname, obsid, filepaths, file_keys, scan_data)
+    if scan_data is not None:
+        return scan_data
+
     scan_data = np.zeros((n_scans, n_feeds, n_sb, n_stats), dtype=np.float32)
     maps = []
-    i_scan = 0
-    for scanid in scans:
-        filepath = l2_path + '/' + fieldname + '/' + fieldname + '_0' + scanid + '.h5'
-        #filepath = l2_path + '/' + fieldname + '_0' + scanid + '.h5'
-        data, map = get_scan_stats(filepath, map_grid)
-        scan_data[i_scan] = data
+    failed = False
+    for j, filepath in enumerate(filepaths):
+        _, _, _, scan_data[j], map, error = get_scan_result((0, j, filepath, fieldname, scans[j], 0))
         maps.append(map)
-        i_scan += 1
-    
-    ps_s_sb_chi2, ps_s_feed_chi2, ps_s_chi2, ps_o_sb_chi2, ps_o_feed_chi2, ps_o_chi2, ps_z_s_sb_chi2, ps_xy_s_sb_chi2 = get_power_spectra(maps, map_grid)
+        if error is not None:
+            scan_errors.setdefault(fieldname, {})[scans[j]] = error
+            failed = True
 
-    insert_data_in_array(scan_data, ps_s_sb_chi2, 'ps_s_sb_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_s_feed_chi2, 'ps_s_feed_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_s_chi2, 'ps_s_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_o_sb_chi2, 'ps_o_sb_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_o_feed_chi2, 'ps_o_feed_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_o_chi2, 'ps_o_chi2', obsid=True)
-
-    insert_data_in_array(scan_data, ps_z_s_sb_chi2, 'ps_z_s_sb_chi2', obsid=True)
-    insert_data_in_array(scan_data, ps_xy_s_sb_chi2, 'ps_xy_s_sb_chi2', obsid=True)
+    _, _, scan_data = reduce_obsid((0, scan_data, maps, fieldname, scans, file_keys, not failed))
+    if n_scans > 0 and not failed:
+        write_stats_cache(fieldname, obsid, filepaths, file_keys, scan_data)
 
     ## [map_list, indices]
     # ## map_list[i][j] = [map, rms]
@@ -1065,7 +2166,7 @@ def get_obsid_data(obsid_info):
     return scan_data
 
 
-def get_power_spectra(maps, map_grid):
+def get_power_spectra(maps, map_grid, scans):
     n_feeds = 20
     n_sb = 4
     n_k = 10
@@ -1102,6 +2203,7 @@ def get_power_spectra(maps, map_grid):
     accepted = np.zeros((n_scans, n_feeds, n_sb))
     for l in range(n_scans):  # need tests for if a scan is 
         map_list, indices = maps[l]
+        rng = get_rng(scans[l], 1)
         # if l == 0:
         #     with open('scan1map.pkl','wb') as my_file:
         #         pickle.dump(maps[l],my_file)
@@ -1128,8 +2230,9 @@ def get_power_spectra(maps, map_grid):
                     
                     # print(map[:,:,10])
                     # print(rms[:,:,10])
-                    ps_s_sb_chi2[l, i, j] = get_ps_chi2(map, rms, n_k, d_th, dz)  # , Pk, ps_mean, ps_std, transfer 
-                    ps_z_s_sb_chi2[l, i, j], ps_xy_s_sb_chi2[l, i, j] = get_ps_1d2d_chi2(map, rms, n_k, d_th, dz)
+                    noise_ps = get_noise_ps(rms, n_k, d_th, dz, rng)  # shared by the 3D and 1D/2D statistics
+                    ps_s_sb_chi2[l, i, j] = get_ps_chi2(map, rms, n_k, d_th, dz, noise_ps=noise_ps['3d'])  # , Pk, ps_mean, ps_std, transfer 
+                    ps_z_s_sb_chi2[l, i, j], ps_xy_s_sb_chi2[l, i, j] = get_ps_1d2d_chi2(map, rms, n_k, d_th, dz, noise_ps=noise_ps['1d2d'])
                     chi2 = ps_s_sb_chi2[l, i, j]
                     # if np.isnan(chi2):
                     #     print("Nan in chi2")
@@ -1154,7 +2257,7 @@ def get_power_spectra(maps, map_grid):
                 ps_s_feed_chi2[l, i, :] = get_ps_chi2(
                     map_feed.reshape((sh[0], sh[1], n_sb * 64)),
                     rms_feed.reshape((sh[0], sh[1], n_sb * 64)),
-                    n_k, d_th, dz, is_feed=True)
+                    n_k, d_th, dz, is_feed=True, rng=rng)
                 where = np.where(rms_feed > 0.0)
                 sum_scan[indices[i, 0, 0] - 1:indices[i, 0, 1], indices[i, 1, 0] - 1:indices[i, 1, 1], :, :][where] += map_feed[where] / rms_feed[where] ** 2 
                 div_scan[indices[i, 0, 0] - 1:indices[i, 0, 1], indices[i, 1, 0] - 1:indices[i, 1, 1], :, :][where] += 1.0 / rms_feed[where] ** 2 
@@ -1177,7 +2280,7 @@ def get_power_spectra(maps, map_grid):
             ps_s_chi2[l, :, :] = get_ps_chi2(
                     map_scan[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
                     rms_scan[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
-                    n_k, d_th, dz, is_feed=True)
+                    n_k, d_th, dz, is_feed=True, rng=rng)
 
             sum_obsid[where] += sum_scan[where]
             div_obsid[where] += div_scan[where]
@@ -1186,6 +2289,7 @@ def get_power_spectra(maps, map_grid):
         ps_o_feed_chi2[:] = np.nan
         ps_o_chi2[:] = np.nan
     else:
+        rng = get_rng(scans[0][:-2], 2)
         map_obsid = np.zeros_like(sum_obsid)
         rms_obsid = np.zeros_like(sum_obsid)
         where = np.where(div_obsid > 0.0)
@@ -1202,7 +2306,7 @@ def get_power_spectra(maps, map_grid):
         ps_o_chi2[:, :, :] = get_ps_chi2(
                     map_obsid[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
                     rms_obsid[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
-                    n_k, d_th, dz, is_feed=True)
+                    n_k, d_th, dz, is_feed=True, rng=rng)
         # sum_sb_obsid = np.zeros((n_feeds, len(ra), len(dec), n_sb, 64)) 
         for i in range(n_feeds):
             min_ind = np.min(ind_feed[:, i, :, 0], axis=0)
@@ -1220,7 +2324,7 @@ def get_power_spectra(maps, map_grid):
                     ps_o_sb_chi2[:, i, j] = get_ps_chi2(
                         map_sb[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
                         rms_sb[min_ind[0] -1:max_ind[0], min_ind[1] -1:max_ind[1]],
-                        n_k, d_th, dz)
+                        n_k, d_th, dz, rng=rng)
             if np.sum(accepted[:, i, :].flatten()) == 0:
                 ps_o_feed_chi2[:, i, :] = np.nan
             else:   
@@ -1235,33 +2339,30 @@ def get_power_spectra(maps, map_grid):
                 ps_o_feed_chi2[:, i, :] = get_ps_chi2(
                         map_feed.reshape((sh[0], sh[1], n_sb * 64)),
                         rms_feed.reshape((sh[0], sh[1], n_sb * 64)),
-                        n_k, d_th, dz, is_feed=True)
+                        n_k, d_th, dz, is_feed=True, rng=rng)
 
     return (ps_s_sb_chi2, ps_s_feed_chi2, ps_s_chi2, ps_o_sb_chi2,
             ps_o_feed_chi2, ps_o_chi2, ps_z_s_sb_chi2, ps_xy_s_sb_chi2)
                 # return (ps_s_sb_chi2, ps_s_feed_chi2, ps_s_chi2, ps_s_stackp_chi2, ps_s_stackfp_chi2, ps_o_sb_chi2,
     #         ps_o_feed_chi2, ps_o_chi2, ps_o_stackp_chi2, ps_o_stackfp_chi2)
 
-def get_ps_chi2(map, rms, n_k, d_th, dz, is_feed=False):
+def get_ps_chi2(map, rms, n_k, d_th, dz, is_feed=False, noise_ps=None, rng=None):
 
     where = np.where(rms > 0)
     k_bin_edges = np.logspace(-1.8, np.log10(0.5), n_k)
     w = np.zeros_like(rms)
     w[where] = 1 / rms[where] ** 2
 
-    Pk, k, nmodes = compute_power_spec3d(w * map, k_bin_edges, d_th, d_th, dz)
+    power_spectrum = get_power_spectrum(map.shape, k_bin_edges, d_th, d_th, dz)
+    Pk, k, nmodes = power_spectrum.power_spec3d(w * map)
 
     where = np.where(Pk > 0)
 
-    n_sim = 100 #20
-    ps_arr = np.zeros((n_sim, n_k - 1))
-    for l in range(n_sim):
-        map_n = np.random.randn(*rms.shape) * rms
-        ps_arr[l] = compute_power_spec3d(w * map_n, k_bin_edges, d_th, d_th, dz)[0]
+    if noise_ps is None:
+        noise_ps = get_noise_ps(rms, n_k, d_th, dz, rng, spectra=('3d',))['3d']
+    ps_mean, ps_std = noise_ps
 
     transfer = 1.0 / np.exp((0.055/k) ** 2.5)  # 6.7e5 / np.exp((0.055/k) ** 2.5)#1.0 / np.exp((0.03/k) ** 2)   ######## Needs to be tested!
-    
-    ps_mean = np.mean(ps_arr, axis=0)
 
     if is_feed:
         # transfer4 = 1.0 / np.exp((0.050/k) ** 5.5)  + 1e-6 
@@ -1269,7 +2370,7 @@ def get_ps_chi2(map, rms, n_k, d_th, dz, is_feed=False):
         # with open("feed_ps.txt", "ab") as myfile:
         #     np.savetxt(myfile, np.array([Pk, ps_mean]).T)
 
-    ps_std = np.std(ps_arr, axis=0) / transfer
+    ps_std = ps_std / transfer
     Pk = Pk / transfer
 
     n_chi2 = len(Pk[where])
@@ -1291,34 +2392,27 @@ def get_ps_chi2(map, rms, n_k, d_th, dz, is_feed=False):
     return chi2 #, Pk, ps_mean, ps_std, transfer
 
 
-def get_ps_1d2d_chi2(map, rms, n_k, d_th, dz, is_feed=False):
+def get_ps_1d2d_chi2(map, rms, n_k, d_th, dz, is_feed=False, noise_ps=None, rng=None):
 
     where = np.where(rms > 0)
     k_bin_edges = np.logspace(-1.45, np.log10(0.1), n_k)
     w = np.zeros_like(rms)
     w[where] = 1 / rms[where] ** 2
 
-    Pk_1D, Pk, k, nmodes = compute_power_spec1d_2d(w * map, k_bin_edges, d_th, d_th, dz)
+    power_spectrum = get_power_spectrum(map.shape, k_bin_edges, d_th, d_th, dz)
+    Pk_1D, Pk, k, nmodes = power_spectrum.power_spec1d_2d(w * map)
 
     where = np.where(Pk > 0)
 
-    n_sim = 100 #20
-    ps_arr = np.zeros((n_sim, n_k - 1))
-    ps_arr_1D = np.zeros((n_sim, len(Pk_1D)))
-    for l in range(n_sim):
-        map_n = np.random.randn(*rms.shape) * rms
-        ps_arr_1D[l], ps_arr[l] = compute_power_spec1d_2d(w * map_n, k_bin_edges, d_th, d_th, dz)[:2]
+    if noise_ps is None:
+        noise_ps = get_noise_ps(rms, n_k, d_th, dz, rng, spectra=('1d2d',))['1d2d']
+    ps_1D_mean, ps_1D_std, ps_mean, ps_std = noise_ps
 
     transfer = 1.0 #/ np.exp((0.055/k) ** 2.5)  # 6.7e5 / np.exp((0.055/k) ** 2.5)#1.0 / np.exp((0.03/k) ** 2)   ######## Needs to be tested!
 
-    ps_mean = np.mean(ps_arr, axis=0)
-    ps_1D_mean = np.mean(ps_arr_1D, axis=0)
-
-    ps_std = np.std(ps_arr, axis=0) / transfer
+    ps_std = ps_std / transfer
     Pk = Pk / transfer
 
-    ps_1D_std = np.std(ps_arr_1D, axis=0)
-
 
     n_chi2 = len(Pk[where])
     
@@ -1342,61 +2436,280 @@ def get_patch_info(path):
         my_dict = { y[0]: y[1:7] for y in my_list[:-1] }
     return my_dict
 
+def get_h5_options(shape):
+    # chunking along scans and compression of a per-scan dataset of the output files
+    if output_layout_version < 2 or shape[0] == 0:
+        return {}
+    return dict(chunks=(min(scan_chunk_size, shape[0]),) + tuple(shape[1:]), **h5_compression)
+
+
 def save_data_2_h5(params, scan_list, scan_data, fieldname, runid):
     filename = data_folder + 'scan_data_' + id_string + fieldname + '.h5'
     f1 = h5py.File(filename, 'w')
+    f1.attrs['layout_version'] = output_layout_version
     f1.create_dataset('scan_list', data=scan_list)
-    f1.create_dataset('scan_data', data=scan_data)
     dt = h5py.special_dtype(vlen=str) 
-    stats_list_arr = np.array(stats_list, dtype=dt)
+    if output_layout_version >= 2:
+        scan_data = get_scan_stats_table(scan_data)
+        group = f1.create_group('scan_data')
+        for stat_string in scan_data.stats:
+            values = scan_data[stat_string]
+            group.create_dataset(stat_string, data=values, **get_h5_options(values.shape))
+        obsids = np.asarray(scan_list) // 100
+        offsets = np.flatnonzero(np.diff(obsids, prepend=-1))
+        f1.create_dataset('obsid_list', data=obsids[offsets])
+        f1.create_dataset('obsid_offsets', data=offsets)
+        stats_list_arr = np.array(scan_data.stats, dtype=dt)
+    else:
+        if isinstance(scan_data, ScanStatsTable):
+            scan_data = scan_data.to_array()
+        f1.create_dataset('scan_data', data=scan_data)
+        stats_list_arr = np.array(stats_list, dtype=dt)
     f1.create_dataset('stats_list', data=stats_list_arr)
     f1.create_dataset("runID", data = runid)
+    errors = scan_errors.get(fieldname, {})
+    if len(errors) > 0:
+        print('Could not process %i scans of %s' % (len(errors), fieldname))
+        f1.create_dataset('failed_scans', data=np.array([int(scanid) for scanid in errors]))
+        f1.create_dataset('failed_reasons', data=np.array(list(errors.values()), dtype=dt))
     f1.close()
     return filename
 
 
-def make_accept_list(params, accept_params, scan_data):
-    n_scans, n_det, n_sb, _ = scan_data.shape
-    accept_list = np.ones((n_scans, n_det, n_sb), dtype=np.bool)
-    reject_reason = np.zeros((n_scans, n_det, n_sb, 100), dtype=np.bool)
+def write_scan_data_stats(filename, stats_data):
+    # replaces the statistics {stat_string: (n_scans, 20, 4)} of a scan data file, of either layout
+    with h5py.File(filename, 'r+') as f1:
+        if f1.attrs.get('layout_version', 1) >= 2:
+            for stat_string, values in stats_data.items():
+                f1['scan_data'][stat_string][...] = values
+        else:
+            file_stats = [s.decode() if isinstance(s, bytes) else s for s in f1['stats_list'][()]]
+            for stat_string, values in stats_data.items():
+                f1['scan_data'][:, :, :, file_stats.index(stat_string)] = values
+
 
-    temp_bool = np.zeros((n_scans, n_det, n_sb), dtype=np.bool)
+def update_runid(filename, runid):
+    with h5py.File(filename, 'r+') as f1:
+        del f1['runID']
+        f1.create_dataset("runID", data = runid)
+    return filename
 
-    # decline all sidebands that are entirely masked
-    acceptrate = extract_data_from_array(scan_data, 'acceptrate')
+
+def read_scan_data(filename, stats=None, scans=None, obsids=None):
+    # scan_list and ScanStatsTable of a scan data file of either layout, reading only the statistics stats
+    # (default all), and only the rows scans, a (start, stop) pair, or the obsids first to last, (first, last)
+    with h5py.File(filename, mode="r") as my_file:
+        file_stats = [s.decode() if isinstance(s, bytes) else s for s in my_file['stats_list'][()]]
+        if stats is None:
+            stats = file_stats
+        scan_list = my_file['scan_list'][()]
+        rows = slice(None) if scans is None else slice(*scans)
+        keep = None
+        if obsids is not None:
+            obsid = scan_list // 100
+            in_range = (obsid >= obsids[0]) & (obsid <= obsids[1])
+            ind = np.flatnonzero(in_range)
+            rows = slice(ind[0], ind[-1] + 1) if len(ind) > 0 else slice(0, 0)
+            keep = in_range[rows]
+        scan_list = scan_list[rows]
+
+        if my_file.attrs.get('layout_version', 1) >= 2:
+            data = np.zeros((len(stats), len(scan_list), 20, 4), dtype=np.float32)
+            for k, stat_string in enumerate(stats):
+                data[k] = my_file['scan_data'][stat_string][rows]
+        else:
+            columns = [file_stats.index(stat_string) for stat_string in stats]
+            if columns == list(range(len(file_stats))):
+                data = np.moveaxis(my_file['scan_data'][rows], -1, 0)
+            else:
+                read_columns = sorted(set(columns))
+                data = np.moveaxis(my_file['scan_data'][rows, :, :, read_columns], -1, 0)
+                data = data[[read_columns.index(column) for column in columns]]
+            data = np.ascontiguousarray(data)
+    if keep is not None:
+        scan_list = scan_list[keep]
+        data = data[:, keep]
+    return scan_list, ScanStatsTable(data, stats)
+
+
+def get_cut_bounds(stats_cut, stats):
+    # lower and upper cut of each of the statistics stats, infinite where there is none, and whether
+    # the statistic has any cut
+    cuts = np.array([stats_cut[stat_string] for stat_string in stats], dtype=np.float64).reshape((-1, 2))
+    has_cut = ~np.all(np.isnan(cuts), axis=1)
+    lower = np.where(np.isnan(cuts[:, 0]), -np.inf, cuts[:, 0])
+    upper = np.where(np.isnan(cuts[:, 1]), np.inf, cuts[:, 1])
+    return lower, upper, has_cut
+
+
+def get_rejected(stats, lower, upper, has_cut):
+    # statistics (..., n_stats) outside their cuts, or nan while having a cut
+    with np.errstate(invalid='ignore'):
+        return (stats < lower) | (stats > upper) | (np.isnan(stats) & has_cut)
+
+
+def feed_median(x):
+    # median over the feeds of each scan and sideband
+    return np.nanmedian(x, axis=1, keepdims=True)
+
+
+def feed_mean(x):
+    return np.nanmean(x, axis=1, keepdims=True)
+
+
+# functions available in virtual_stats and expr_cuts of accept_params. Apart from feed_median and feed_mean,
+# which only combine the feeds of one scan and sideband, they are elementwise, so an expression never
+# mixes scans and gives the same result for any block of scans (see iter_scan_blocks).
+cut_functions = {'abs': np.abs, 'sqrt': np.sqrt, 'exp': np.exp, 'log': np.log, 'log10': np.log10,
+                 'sin': np.sin, 'cos': np.cos, 'tan': np.tan, 'arctan2': np.arctan2, 'deg2rad': np.deg2rad,
+                 'floor': np.floor, 'ceil': np.ceil, 'mod': np.mod, 'minimum': np.minimum, 'maximum': np.maximum,
+                 'clip': np.clip, 'where': np.where, 'isnan': np.isnan, 'isfinite': np.isfinite,
+                 'nan': np.nan, 'inf': np.inf, 'pi': np.pi,
+                 'feed_median': feed_median, 'feed_mean': feed_mean, '__builtins__': {}}
+
+
+class CutColumns(dict):
+    # the statistics of a ScanStatsTable by name, virtual statistics are computed when first used
+    def __init__(self, table, virtual_stats):
+        self.table = table
+        self.virtual_stats = virtual_stats
+
+    def __missing__(self, name):
+        if name in self.virtual_stats:
+            with np.errstate(invalid='ignore', divide='ignore'):
+                value = np.broadcast_to(eval(self.virtual_stats[name], cut_functions, self), self.table.shape[:-1])
+        elif name in self.table:
+            value = self.table[name]
+        else:
+            raise KeyError(name)  # eval then looks in cut_functions
+        self[name] = value
+        return value
+
+
+class AcceptCuts():
+    # All cuts of accept_params: the [min, max] cuts of stats_cut on the statistics stats and on the virtual
+    # statistics, expressions of other statistics in virtual_stats, and the expression cuts expr_cuts, which
+    # accept where they are true. Cuts are ordered as names, which is also the order of the reject bits.
+    def __init__(self, stats_cut, stats, virtual_stats=None, expr_cuts=None):
+        self.stats = list(stats)
+        self.virtual_stats = {name: compile(expr, name, 'eval') for name, expr in (virtual_stats or {}).items()}
+        self.expr_cuts = {name: compile(expr, name, 'eval') for name, expr in (expr_cuts or {}).items()}
+        self.virtual_cuts = [name for name in self.virtual_stats if name in stats_cut]
+        self.names = self.stats + self.virtual_cuts + list(self.expr_cuts)
+        self.descriptions = [stats_cut[name] for name in self.stats + self.virtual_cuts] + list((expr_cuts or {}).values())
+        self.lower, self.upper, self.has_cut = get_cut_bounds(stats_cut, self.stats + self.virtual_cuts)
+
+    def get_columns(self, table):
+        return CutColumns(table, self.virtual_stats)
+
+    def iter_rejected(self, table):
+        # index k and the rejected sidebands (n_scans, n_det, n_sb) of every cut k of the ScanStatsTable table
+        # that can reject anything, one statistic or expression at a time
+        columns = self.get_columns(table)
+        for k, name in enumerate(self.stats + self.virtual_cuts):
+            if self.has_cut[k]:
+                yield k, get_rejected(columns[name], self.lower[k], self.upper[k], True)
+        n_stats_cuts = len(self.lower)
+        for j, expr in enumerate(self.expr_cuts.values()):
+            with np.errstate(invalid='ignore', divide='ignore'):
+                accepted = np.broadcast_to(eval(expr, cut_functions, columns), table.shape[:-1])
+            yield n_stats_cuts + j, ~accepted.astype(bool)
+
+
+def get_accept_cuts(accept_params, stats):
+    return AcceptCuts(accept_params.stats_cut, stats, getattr(accept_params, 'virtual_stats', None), getattr(accept_params, 'expr_cuts', None))
+
+
+def load_param_module(params, key):
+    # python module given by the parameter key, in ACCEPT_PARAM_FOLDER
+    filename = params[key]
+    spec = importlib.util.spec_from_file_location(filename[:-3], params['ACCEPT_PARAM_FOLDER'] + filename)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+def get_n_scans(scan_data):
+    # number of scans of a ScanStatsTable, scan_data array or scan data file
+    if isinstance(scan_data, str):
+        with h5py.File(scan_data, mode="r") as my_file:
+            return len(my_file['scan_list'])
+    return scan_data.shape[0]
+
+
+def iter_scan_blocks(scan_data, stats=None):
+    # (start, ScanStatsTable) blocks of accept_block_size scans of a ScanStatsTable or of a scan data file,
+    # which is read one block at a time with only the statistics stats (default all)
+    n_scans = get_n_scans(scan_data)
+    for start in range(0, n_scans, accept_block_size):
+        stop = min(start + accept_block_size, n_scans)
+        if isinstance(scan_data, str):
+            _, block = read_scan_data(scan_data, stats, scans=(start, stop))
+        else:
+            block = ScanStatsTable(scan_data.data[:, start:stop], scan_data.stats)
+        yield start, block
+
+
+def make_accept_list(params, accept_params, scan_data):
+    # all cuts are evaluated in one pass over the statistics of each block of scans (see iter_scan_blocks),
+    # scan_data is a ScanStatsTable, a scan_data array or a scan data file, which is streamed. A sideband
+    # is rejected by a statistic outside its cuts, or nan if the statistic has a cut, and by the virtual
+    # statistics and expression cuts of accept_params (see AcceptCuts). reject_reason holds one bit per
+    # cut (bit i % 64 of word i // 64 is cut i, in the order of AcceptCuts.names, see unpack_reject_reason),
+    # and acc, the mean acceptrate left after each cut, follows from the first cut rejecting each sideband.
+    if isinstance(scan_data, str):
+        stats = stats_list
+    else:
+        scan_data = get_scan_stats_table(scan_data)
+        stats = scan_data.stats
+    n_scans = get_n_scans(scan_data)
+    n_det, n_sb = 20, 4
+    cuts = get_accept_cuts(accept_params, stats)
+    n_cuts = len(cuts.names)
+    n_words = (n_cuts + 63) // 64
+    accept_list = np.zeros((n_scans, n_det, n_sb), dtype=bool)
+    reject_reason = np.zeros((n_scans, n_det, n_sb, n_words), dtype=np.uint64)
 
     # accept_list[:, 7, :] = False    
-    
-    acc = np.zeros(len(stats_list) + 1)
-    acc[0] = np.nansum(acceptrate[accept_list]) / (n_scans * 19 * 4)
+
+    total = 0.0
+    lost = np.zeros(n_cuts + 1)
+    for start, block in iter_scan_blocks(scan_data, stats):
+        stop = start + block.shape[0]
+        words = np.zeros((n_words,) + block.shape[:-1], dtype=np.uint64)
+        # index of the first cut rejecting each sideband, n_cuts if it is accepted
+        first_cut = np.full(block.shape[:-1], n_cuts, dtype=np.int32)
+        for k, rejected in cuts.iter_rejected(block):
+            words[k // 64] |= rejected.astype(np.uint64) << np.uint64(k % 64)
+            np.minimum(first_cut, np.where(rejected, k, n_cuts), out=first_cut)
+        accept_list[start:stop] = first_cut == n_cuts
+        reject_reason[start:stop] = np.moveaxis(words, 0, -1)
+
+        # decline all sidebands that are entirely masked
+        weights = np.nan_to_num(extract_data_from_array(block, 'acceptrate'), nan=0.0).astype(np.float64).ravel()
+        total += np.sum(weights)
+        lost += np.bincount(first_cut.ravel(), weights=weights, minlength=n_cuts + 1)
+
+    acc = np.zeros(n_cuts + 1)
+    acc[0] = total
+    acc[1:] = total - np.cumsum(lost[:n_cuts])
+    acc /= (n_scans * 19 * 4)
     print(acc[0], 'before cuts')
-    for i, stat_string in enumerate(stats_list):
-        stats = extract_data_from_array(scan_data, stat_string)
-        cuts = accept_params.stats_cut[stat_string]
-        temp_bool[:, :, :] = False
-        if (not np.isnan(cuts[0])):
-            accept_list[np.where(stats < cuts[0])] = False
-            accept_list[np.where(np.isnan(stats))] = False
-            temp_bool[np.where(stats < cuts[0])] = True
-            temp_bool[np.where(np.isnan(stats))] = True
-            reject_reason[:, :, :, i] = temp_bool
-            # reject_reason[:, :, :, i][np.argwhere(stats < cuts[0])] = True
-            # reject_reason[:, :, :, i][np.argwhere(np.isnan(stats))] = True
-        if (not np.isnan(cuts[1])):
-            accept_list[np.where(stats > cuts[1])] = False
-            accept_list[np.where(np.isnan(stats))] = False
-            temp_bool[np.where(stats > cuts[1])] = True
-            temp_bool[np.where(np.isnan(stats))] = True
-            reject_reason[:, :, :, i] = temp_bool
-            # reject_reason[:, :, :, i][np.argwhere(stats < cuts[1])] = True
-            # reject_reason[:, :, :, i][np.argwhere(np.isnan(stats))] = True
-        
-        acc[i+1] = np.nansum(acceptrate[accept_list]) / (n_scans * 19 * 4)
-        print(acc[i+1], stat_string, cuts)
+    for i, (cut_string, description) in enumerate(zip(cuts.names, cuts.descriptions)):
+        print(acc[i+1], cut_string, description)
 
     return accept_list, reject_reason, acc
 
 
+def unpack_reject_reason(reject_reason, n_cuts=None):
+    # bool array (n_scans, n_det, n_sb, n_cuts) of the packed reject_reason of make_accept_list,
+    # n_cuts defaults to the number of statistics
+    if n_cuts is None:
+        n_cuts = len(stats_list)
+    packed = np.ascontiguousarray(reject_reason, dtype='<u8').view(np.uint8)
+    return np.unpackbits(packed, axis=-1, count=n_cuts, bitorder='little').astype(bool)
+
+
 def read_jk_param(filepath):
     with open(filepath) as my_file:
         lines = [line.split()[:2] for line in my_file]
@@ -1407,150 +2720,335 @@ def read_jk_param(filepath):
     return strings, types, n_split
 
 
-def make_jk_list(params, accept_list, scan_list, scan_data, jk_param):
-    strings, types, n_split = read_jk_param(jk_param)
-    
-    cutoff_list = np.zeros((n_split-1), dtype='f')
-    
-    n_scans, n_det, n_sb, _ = scan_data.shape
-    jk_list = np.zeros((n_scans, n_det, n_sb), dtype=np.int32)
-
-    if not np.any(accept_list.flatten()):
-        jk_list[:] = 0 
-        return jk_list, cutoff_list, strings
-    
-    for j, string in enumerate(strings):
-        implement_split(scan_data, jk_list, cutoff_list, string, j+1)
-
-    # insert 0 on rejected sidebands, add 1 on accepted 
-    jk_list[np.invert(accept_list)] = 0
-    jk_list[accept_list] += 1 
-    return jk_list, cutoff_list, strings
-
-
-def implement_split(scan_data, jk_list, cutoff_list, string, n):
-
-    # even/odd
-    if string == 'odde':
-        obsid = [int(str(scanid)[:-2]) for scanid in scan_list]
-        odd = np.array(obsid) % 2
-
-        jk_list[:] += odd[:, None, None] * int(2 ** n)
-        cutoff_list[n-1] = 0.0 # placeholder (no real cutoff value)
-    elif string == 'dayn':
-        # day/night split
-        closetonight = extract_data_from_array(scan_data, 'night')
-        
-        cutoff = np.percentile(closetonight[accept_list], 50.0)
-        jk_list[np.where(closetonight > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-    elif string == 'half':
-        # halfmission split
-        mjd = extract_data_from_array(scan_data, 'mjd')
-        cutoff = np.percentile(mjd[accept_list], 50.0)
-        jk_list[np.where(mjd > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-    elif string == 'sdlb':
-        # saddlebag split
-        saddlebags = extract_data_from_array(scan_data, 'saddlebag')
-        jk_list[np.where(saddlebags > 2.5)] += int(2 ** n)
-        cutoff_list[n-1] = 0.0 # placeholder
-    elif string == 'sidr':
-        # sidereal time split 
-        sid = extract_data_from_array(scan_data, 'sidereal')
-        cutoff = np.percentile(sid[accept_list], 50.0)
-        # print('Sidereal time cutoff: ', cutoff)
-        jk_list[np.where(sid > cutoff)] += int(2 ** n) 
-        cutoff_list[n-1] = cutoff
-    elif string == 'cesc':
-        fbit = extract_data_from_array(scan_data, 'fbit')
-        jk_list[np.where(fbit == 32)] += int(2 ** n) 
-        cutoff_list[n-1] = 0.0 # placeholder
-    elif string == 'ambt':
-        # ambient temperature split 
-        ambt = extract_data_from_array(scan_data, 'airtemp')
-        cutoff = np.percentile(ambt[accept_list], 50.0)
-        jk_list[np.where(ambt > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-    elif string == 'elev':
-        # elevation split 
-        el = extract_data_from_array(scan_data, 'el')
-        cutoff = np.percentile(el[accept_list], 50.0)
-        jk_list[np.where(el > cutoff)] += int(2 ** n) 
-        cutoff_list[n-1] = cutoff
-    elif string == 'wind':
-        # windspeed split 
-        wind = extract_data_from_array(scan_data, 'windspeed')
-        cutoff = np.percentile(wind[accept_list], 50.0)
-        jk_list[np.where(wind > cutoff)] += int(2 ** n) 
-        cutoff_list[n-1] = cutoff
-    elif string == 'sune':
-        # sun_elevation split 
-        sunel = extract_data_from_array(scan_data, 'sun_el')
-        cutoff = np.percentile(sunel[accept_list], 50.0)
-        jk_list[np.where(sunel > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-
-    elif string == 'snup':
-        # sun_up split (sun elevation > -5 deg) 
-        sunel = extract_data_from_array(scan_data, 'sun_el')
-        jk_list[np.where(sunel > -5.0)] += int(2 ** n) 
-        cutoff_list[n-1] = 0.0 # placeholder
-
-    elif string == 'wint':
-        mjd = extract_data_from_array(scan_data, 'mjd')
-        mid_winter = 58863  # 15. Jan 2020
-        days_since_mid_winter = (mjd - mid_winter) % 365                                                                                                                                                         
-        close_to_winter = np.minimum(np.abs(days_since_mid_winter), np.abs(365 - days_since_mid_winter))
-        cutoff = np.percentile(close_to_winter[accept_list], 50.0)
-        jk_list[np.where(close_to_winter > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-
-    elif string == 'rise':
-        sid = extract_data_from_array(scan_data, 'sidereal')
-        if fieldname == 'co2':
-            cutoff = 87
-        elif fieldname == 'co6':
-            wh = np.where(sid > 180)
-            sid[wh] -= 360
-            cutoff = -75
-        elif fieldname == 'co7':
-            cutoff = 231
-        else:
-            print('Unknown field: ', fieldname, ' rising split invalid')
-            cutoff = 0
-        jk_list[np.where(sid < cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-
-    elif string == 'fpol':  ## fknee of second polyfilter component
-        fknee = extract_data_from_array(scan_data, 'fknee_poly1')
-        cutoff = np.percentile(fknee[accept_list], 50.0)
-        jk_list[np.where(fknee > cutoff)] += int(2 ** n)
-        cutoff_list[n-1] = cutoff
-
-        ######## Here you can add new jack-knives  ############
-        ### elif .......:
-        ###
+def get_jk_odd(scan_data, scan_list, fieldname):
+    # even/odd obsid
+    odd = (np.asarray(scan_list) // 100) % 2
+    return np.broadcast_to(odd[:, None, None], scan_data.shape[:3])
+
+
+def get_jk_winter(scan_data, scan_list, fieldname):
+    # days from mid winter
+    mjd = extract_data_from_array(scan_data, 'mjd')
+    mid_winter = 58863  # 15. Jan 2020
+    days_since_mid_winter = (mjd - mid_winter) % 365
+    return np.minimum(np.abs(days_since_mid_winter), np.abs(365 - days_since_mid_winter))
+
+
+def get_jk_rising(scan_data, scan_list, fieldname):
+    # sidereal time, continuous around the rising cutoff of the field
+    sid = extract_data_from_array(scan_data, 'sidereal')
+    if fieldname == 'co6':
+        sid = np.where(sid > 180, sid - 360, sid)
+    return sid
+
+
+# split variables that are not a statistic of stats_list
+jk_variables = {
+    'odd': get_jk_odd,
+    'winter': get_jk_winter,
+    'rising': get_jk_rising,
+}
+
+# statistics of the split variables in jk_variables
+jk_variable_stats = {'odd': [], 'winter': ['mjd'], 'rising': ['sidereal']}
+
+# cutoffs of the rising split
+jk_rise_cutoffs = {'co2': 87, 'co6': -75, 'co7': 231}
+
+# split name: (variable, cutoff, comparison). A sideband is in the upper half of the split if
+# "variable comparison cutoff". The cutoff is either 'median', the median over the accepted sidebands,
+# 'field', from jk_rise_cutoffs, or a fixed value, which is saved as 0 in the cutoff_list (a placeholder).
+# New jack-knives are added here.
+jk_splits = {
+    'odde': ('odd', 0.5, '>'),
+    'dayn': ('night', 'median', '>'),  # day/night split
+    'half': ('mjd', 'median', '>'),  # halfmission split
+    'sdlb': ('saddlebag', 2.5, '>'),  # saddlebag split
+    'sidr': ('sidereal', 'median', '>'),  # sidereal time split
+    'cesc': ('fbit', 32, '=='),
+    'ambt': ('airtemp', 'median', '>'),  # ambient temperature split
+    'elev': ('el', 'median', '>'),  # elevation split
+    'wind': ('windspeed', 'median', '>'),  # windspeed split
+    'sune': ('sun_el', 'median', '>'),  # sun_elevation split
+    'snup': ('sun_el', -5.0, '>'),  # sun_up split (sun elevation > -5 deg)
+    'wint': ('winter', 'median', '>'),
+    'rise': ('rising', 'field', '<'),
+    'fpol': ('fknee_poly1', 'median', '>'),  # fknee of second polyfilter component
+}
+
+jk_comparisons = {'>': np.greater, '<': np.less, '==': np.equal}
+
+
+def get_jk_variable(scan_data, scan_list, variable, fieldname):
+    if variable in jk_variables:
+        values = jk_variables[variable](scan_data, scan_list, fieldname)
     else:
-        print('Unknown split type: ', string)
-    return jk_list
-
-
-def save_jk_2_h5(params, scan_list, acceptrates, accept_list, reject_reason, jk_list, cutoff_list, split_list, fieldname, runID): 
-    filename = data_folder + 'jk_data_' + id_string + jk_string + fieldname + '.h5'
+        values = extract_data_from_array(scan_data, variable)
+    return np.broadcast_to(values, scan_data.shape[:3])
+
+
+class QuantileSketch():
+    # KLL quantile sketch of a stream of values (nan skipped). Level h holds items of weight 2 ** h, and a
+    # full level is compacted by keeping every other sorted item, from a random first one, in the level
+    # above. Sketches of different blocks, shards or fields are combined with merge.
+    def __init__(self, k=200, seed=0):
+        self.k = k
+        self.n = 0
+        self.levels = [np.zeros(0)]
+        self.rng = np.random.default_rng(seed)
+
+    def get_capacity(self, h):
+        depth = len(self.levels) - 1 - h
+        return max(int(np.ceil(self.k * (2.0 / 3) ** depth)), 2)
+
+    def compress(self):
+        h = 0
+        while h < len(self.levels):
+            if len(self.levels[h]) > self.get_capacity(h):
+                if h + 1 == len(self.levels):
+                    self.levels.append(np.zeros(0))
+                items = np.sort(self.levels[h])
+                # an odd item is left on the level
+                n_pairs = len(items) // 2
+                promoted = items[:2 * n_pairs][self.rng.integers(2)::2]
+                self.levels[h + 1] = np.concatenate((self.levels[h + 1], promoted))
+                self.levels[h] = items[2 * n_pairs:]
+            h += 1
+
+    def update(self, values):
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        self.n += len(values)
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self.compress()
+
+    def merge(self, other):
+        for h, items in enumerate(other.levels):
+            if h == len(self.levels):
+                self.levels.append(np.zeros(0))
+            self.levels[h] = np.concatenate((self.levels[h], items))
+        self.n += other.n
+        self.compress()
+
+    def quantile(self, q):
+        # smallest item with at least the fraction q of the total weight at or below it, nan if empty
+        items = np.concatenate(self.levels)
+        if len(items) == 0:
+            return np.nan
+        weights = np.concatenate([np.full(len(level), 2 ** h) for h, level in enumerate(self.levels)])
+        order = np.argsort(items, kind='stable')
+        cumsum = np.cumsum(weights[order])
+        return items[order][min(np.searchsorted(cumsum, q * cumsum[-1]), len(items) - 1)]
+
+
+def get_jk_sketches(scan_data, scan_list, accept_list, names, fieldname):
+    # QuantileSketch of each of the split variables names over the accepted sidebands, in one pass over
+    # the scans of a ScanStatsTable or a scan data file
+    sketches = {name: QuantileSketch(jk_sketch_k) for name in names}
+    for start, block in iter_scan_blocks(scan_data, get_jk_stats(names)):
+        stop = start + block.shape[0]
+        variables = get_jk_block_variables(block, scan_list[start:stop], names, fieldname)
+        for name, values in zip(names, variables[:, accept_list[start:stop]]):
+            sketches[name].update(values)
+    return sketches
+
+
+def get_jk_stats(names):
+    # statistics needed by the splits names
+    stats = []
+    for name in names:
+        variable = jk_splits[name][0]
+        for stat_string in jk_variable_stats.get(variable, [variable]):
+            if stat_string not in stats:
+                stats.append(stat_string)
+    return stats
+
+
+def get_jk_block_variables(block, scan_list, names, fieldname):
+    variables = np.zeros((len(names),) + block.shape[:3], dtype=np.float32)
+    for k, name in enumerate(names):
+        variables[k] = get_jk_variable(block, scan_list, jk_splits[name][0], fieldname)
+    return variables
+
+
+def get_sortable_keys(values):
+    # unsigned integers ordered like the float32 values
+    bits = np.ascontiguousarray(values, dtype=np.float32).view(np.uint32)
+    return np.where(bits >> 31, ~bits, bits | np.uint32(1 << 31))
+
+
+def get_sortable_values(keys):
+    keys = np.asarray(keys, dtype=np.uint32)
+    return np.where(keys >> 31, keys & np.uint32(0x7fffffff), ~keys).view(np.float32)
+
+
+def get_exact_medians(get_values, n_rows):
+    # np.nanpercentile(values, 50) of each of n_rows streams of float32 values, where get_values() yields
+    # blocks (n_rows, n) of them. Two passes over the blocks select the middle values by their sortable keys,
+    # first by the upper 16 bits and then by the lower 16 bits in the selected bins. The median then
+    # follows from these one or two values as for the full array.
+    counts = np.zeros((n_rows, 1 << 16), dtype=np.int64)
+    for values in get_values():
+        for k in range(n_rows):
+            row = values[k][~np.isnan(values[k])]
+            counts[k] += np.bincount(get_sortable_keys(row) >> 16, minlength=1 << 16)
+    n = np.sum(counts, axis=1)
+    cumsum = np.cumsum(counts, axis=1)
+    ranks = [sorted({(n[k] - 1) // 2, n[k] // 2}) if n[k] > 0 else [] for k in range(n_rows)]
+    high = [np.searchsorted(cumsum[k], ranks[k], side='right') for k in range(n_rows)]
+
+    low_counts = [{b: np.zeros(1 << 16, dtype=np.int64) for b in high[k]} for k in range(n_rows)]
+    for values in get_values():
+        for k in range(n_rows):
+            if len(high[k]) == 0:
+                continue
+            keys = get_sortable_keys(values[k][~np.isnan(values[k])])
+            for b in low_counts[k]:
+                low_counts[k][b] += np.bincount(keys[(keys >> 16) == b] & 0xffff, minlength=1 << 16)
+
+    medians = np.zeros(n_rows, dtype=np.float32)
+    for k in range(n_rows):
+        if n[k] == 0:
+            medians[k] = np.nan
+            continue
+        middle = []
+        for rank, b in zip(ranks[k], high[k]):
+            rank_in_bin = rank - (cumsum[k, b] - counts[k, b])
+            low = np.searchsorted(np.cumsum(low_counts[k][b]), rank_in_bin, side='right')
+            middle.append(get_sortable_values((int(b) << 16) | int(low)))
+        if n[k] % 2 == 0 and len(middle) == 1:
+            middle = middle * 2
+        medians[k] = np.percentile(np.array(middle, dtype=np.float32), 50.0)
+    return medians
+
+
+def get_jk_cutoffs(scan_data, scan_list, accept_list, names, fieldname):
+    # cutoffs of the splits names and the cutoffs saved in the cutoff_list. The medians over the accepted
+    # sidebands are taken of all variables at once in memory, or exactly in two passes over a scan data file,
+    # or are estimated by QuantileSketches if jk_quantile_mode is 'sketch'.
+    cutoffs = np.zeros(len(names), dtype=np.float32)
+    saved_cutoffs = np.zeros(len(names), dtype=np.float32)
+    for k, name in enumerate(names):
+        cutoff = jk_splits[name][1]
+        if cutoff == 'field':
+            if fieldname not in jk_rise_cutoffs:
+                print('Unknown field: ', fieldname, ' rising split invalid')
+            cutoffs[k] = saved_cutoffs[k] = jk_rise_cutoffs.get(fieldname, 0)
+        elif cutoff != 'median':
+            cutoffs[k] = cutoff
+
+    median = [k for k, name in enumerate(names) if jk_splits[name][1] == 'median']
+    if len(median) == 0:
+        return cutoffs, saved_cutoffs
+    median_names = [names[k] for k in median]
+    if jk_quantile_mode == 'sketch':
+        sketches = get_jk_sketches(scan_data, scan_list, accept_list, median_names, fieldname)
+        medians = [sketches[name].quantile(0.5) for name in median_names]
+    elif isinstance(scan_data, str):
+        def get_values():
+            for start, block in iter_scan_blocks(scan_data, get_jk_stats(median_names)):
+                stop = start + block.shape[0]
+                variables = get_jk_block_variables(block, scan_list[start:stop], median_names, fieldname)
+                yield variables[:, accept_list[start:stop]]
+        medians = get_exact_medians(get_values, len(median))
+    else:
+        variables = get_jk_block_variables(scan_data, scan_list, median_names, fieldname)
+        medians = np.nanpercentile(variables[:, accept_list], 50.0, axis=1)
+    cutoffs[median] = saved_cutoffs[median] = medians
+    return cutoffs, saved_cutoffs
+
+
+def get_jk_upper(variables, cutoffs, names):
+    # upper half (n_split, ...) of the splits names
+    upper = np.zeros(variables.shape, dtype=bool)
+    for comparison, compare in jk_comparisons.items():
+        rows = [k for k, name in enumerate(names) if jk_splits[name][2] == comparison]
+        if len(rows) > 0:
+            upper[rows] = compare(variables[rows], cutoffs[rows][:, None, None, None])
+    return upper
+
+
+def make_jk_lists(params, accept_list, scan_list, scan_data, jk_params, fieldname):
+    # jk_list, cutoff_list and split names of every jackknife definition file in jk_params. Split n of a
+    # file (from 1) sets bit n of the jk_list in its upper half, and bit 0 is set on accepted sidebands.
+    # The splits of all files are computed together, block by block of scans (see iter_scan_blocks), and
+    # scan_data is a ScanStatsTable, a scan_data array or a scan data file, which is streamed.
+    definitions = [read_jk_param(jk_param) for jk_param in jk_params]
+    names = []
+    for strings, _, _ in definitions:
+        for string in strings:
+            if string not in jk_splits:
+                print('Unknown split type: ', string)
+            elif string not in names:
+                names.append(string)
+
+    if not isinstance(scan_data, str):
+        scan_data = get_scan_stats_table(scan_data)
+    n_scans = get_n_scans(scan_data)
+    n_det, n_sb = 20, 4
+    jk_lists = []
+    bits = []
+    rows = []
+    for strings, types, n_split in definitions:
+        cutoff_list = np.zeros((n_split-1), dtype='f')
+        jk_list = np.zeros((n_scans, n_det, n_sb), dtype=np.int32)
+        jk_lists.append((jk_list, cutoff_list, strings))
+        known = [j for j, string in enumerate(strings) if string in jk_splits]
+        rows.append([names.index(strings[j]) for j in known])
+        bits.append(np.array([2 ** (j + 1) for j in known], dtype=np.int32))
+
+    if not np.any(accept_list):
+        return jk_lists
+
+    if len(names) > 0:
+        cutoffs, saved_cutoffs = get_jk_cutoffs(scan_data, scan_list, accept_list, names, fieldname)
+        for start, block in iter_scan_blocks(scan_data, get_jk_stats(names)):
+            stop = start + block.shape[0]
+            variables = get_jk_block_variables(block, scan_list[start:stop], names, fieldname)
+            upper = get_jk_upper(variables, cutoffs, names)
+            for (jk_list, _, _), file_rows, file_bits in zip(jk_lists, rows, bits):
+                jk_list[start:stop] = np.tensordot(file_bits, upper[file_rows], axes=1)
+
+    for (jk_list, cutoff_list, strings), file_rows in zip(jk_lists, rows):
+        known = [j for j, string in enumerate(strings) if string in jk_splits]
+        if len(known) > 0:
+            cutoff_list[known] = saved_cutoffs[file_rows]
+
+        # insert 0 on rejected sidebands, add 1 on accepted 
+        jk_list[np.invert(accept_list)] = 0
+        jk_list[accept_list] += 1 
+    return jk_lists
+
+
+def make_jk_list(params, accept_list, scan_list, scan_data, jk_param, fieldname):
+    return make_jk_lists(params, accept_list, scan_list, scan_data, [jk_param], fieldname)[0]
+
+
+def save_jk_2_h5(params, scan_list, acceptrates, accept_list, reject_reason, jk_list, cutoff_list, split_list, fieldname, runID, jk_data_string=None, cut_list=None): 
+    if jk_data_string is None:
+        jk_data_string = jk_string
+    filename = data_folder + 'jk_data_' + id_string + jk_data_string + fieldname + '.h5'
     f1 = h5py.File(filename, 'w')
+    f1.attrs['layout_version'] = output_layout_version
     f1.create_dataset('scan_list', data=scan_list)
     f1.create_dataset('acceptrates', data=acceptrates)
-    f1.create_dataset('accept_list', data=accept_list)
-    f1.create_dataset('reject_reason', data=reject_reason)
-    f1.create_dataset('jk_list', data=jk_list)
+    f1.create_dataset('accept_list', data=accept_list, **get_h5_options(accept_list.shape))
+    # reject_reason is bit-packed (n_scans, 20, 4, n_words) uint64, no longer bool (n_scans, 20, 4, n_stats),
+    # readers check its attributes and unpack it with unpack_reject_reason
+    f1.create_dataset('reject_reason', data=reject_reason, **get_h5_options(reject_reason.shape))
+    f1['reject_reason'].attrs['encoding'] = 'packed_bits'
+    f1['reject_reason'].attrs['bitorder'] = 'little'  # bit i % 64 of uint64 word i // 64 is cut i of cut_list
+    f1['reject_reason'].attrs['n_cuts'] = len(cut_list) if cut_list is not None else len(stats_list)
+    f1.create_dataset('jk_list', data=jk_list, **get_h5_options(jk_list.shape))
     f1.create_dataset('cutoff_list', data=cutoff_list)
     dt = h5py.special_dtype(vlen=str)
     stats_list_arr = np.array(stats_list, dtype=dt)
     f1.create_dataset('stats_list', data=stats_list_arr)
     split_list_arr = np.array(split_list, dtype=dt)
     f1.create_dataset('split_list', data=split_list_arr)
-    f1.create_dataset("runID", data = runid)
+    if cut_list is not None:  # names of the bits of reject_reason
+        f1.create_dataset('cut_list', data=np.array(cut_list, dtype=dt))
+    f1.create_dataset("runID", data = runID)
     f1.close()
     return filename
 
@@ -1574,13 +3072,9 @@ if __name__ == "__main__":
     params = get_params(param_file)
     #sys.path.append(params['ACCEPT_PARAM_FOLDER'])
     #accept_params = importlib.import_module(params['ACCEPT_PARAM_FOLDER'] + params['ACCEPT_MOD_PARAMS'][:-3])
-    spec = importlib.util.spec_from_file_location(params['ACCEPT_MOD_PARAMS'][:-3], params['ACCEPT_PARAM_FOLDER'] + params['ACCEPT_MOD_PARAMS'])
-    accept_params = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(accept_params)
-    spec = importlib.util.spec_from_file_location(params['STATS_LIST'][:-3], params['ACCEPT_PARAM_FOLDER'] + params['STATS_LIST'])    
-    stats_list = importlib.util.module_from_spec(spec)
-    spec.loader.exec_module(stats_list)
-    stats_list = stats_list.stats_list
+    accept_params = load_param_module(params, 'ACCEPT_MOD_PARAMS')
+    stats_list = load_param_module(params, 'STATS_LIST').stats_list
+    cut_list = get_accept_cuts(accept_params, stats_list).names
     fields = read_runlist(params)
 
     patch_filepath = params['PATCH_DEFINITION_FILE']
@@ -1589,13 +3083,44 @@ if __name__ == "__main__":
     weather_filepath = params['WEATHER_FILEPATH']
     data_folder = params['ACCEPT_DATA_FOLDER']
     id_string = params['ACCEPT_DATA_ID_STRING'] + '_'
-    jk_string = params['JK_DATA_STRING'] + '_'
+    jk_string = params['JK_DATA_STRING'] + '_' if isinstance(params['JK_DATA_STRING'], str) else ''
     if id_string == '_':
         id_string = ''
     if jk_string == '_':
         jk_string = ''
     data_from_file = params['SCAN_STATS_FROM_FILE'] # False #True
+    ps_noise_mode = params.get('PS_NOISE_MODE', 'mc')
+    n_sim_ps = int(params.get('PS_N_SIM', 100))
+    ps_sim_seed = int(params.get('PS_SIM_SEED', 0))
+    noise_fit_method = params.get('NOISE_FIT_METHOD', 'curve_fit')
+    scan_stats_streaming = bool(params.get('SCAN_STATS_STREAMING', False))
+    scan_stats_memory_limit = float(params.get('SCAN_STATS_MEMORY_LIMIT', 512))
+    scan_stats_cache_dir = params.get('SCAN_STATS_CACHE_DIR', None)
+    map_cache_dir = params.get('MAP_CACHE_DIR', None)
+    n_workers = params.get('N_WORKERS', None)
+    scan_retries = int(params.get('SCAN_RETRIES', 0))
+    scan_timeout = int(params.get('SCAN_TIMEOUT', 0))
+    checkpoint_dir = params.get('CHECKPOINT_DIR', data_folder + 'checkpoints/' + id_string + 'scan_data')
+    checkpoint_interval = float(params.get('CHECKPOINT_INTERVAL', 600))
+    output_layout_version = int(params.get('OUTPUT_LAYOUT_VERSION', 1))
+    accept_streaming = bool(params.get('ACCEPT_STREAMING', False))
+    accept_block_size = int(params.get('ACCEPT_BLOCK_SIZE', 4096))
+    jk_quantile_mode = params.get('JK_QUANTILE_MODE', 'exact')
+    if jk_quantile_mode not in ('exact', 'sketch'):
+        raise ValueError('Unknown JK_QUANTILE_MODE: %s' % jk_quantile_mode)
+    jk_sketch_k = int(params.get('JK_SKETCH_K', 200))
     jk_param_list_file = params['JK_DEF_FILE']
+    # several jackknife definition files can be given as a list, their jk data is named by
+    # a list of JK_DATA_STRINGs, or else by JK_DATA_STRING and the name of the definition file
+    if isinstance(jk_param_list_file, str):
+        jk_param_files = [jk_param_list_file]
+        jk_strings = [jk_string]
+    else:
+        jk_param_files = list(jk_param_list_file)
+        if isinstance(params['JK_DATA_STRING'], str):
+            jk_strings = [jk_string + jk_param_file.split("/")[-1][:-4] + '_' for jk_param_file in jk_param_files]
+        else:
+            jk_strings = [string + '_' if string != '' else '' for string in params['JK_DATA_STRING']]
     show_plot = params['SHOW_ACCEPT_PLOT']
 
     scan_data_data_name_list = []
@@ -1607,30 +3132,54 @@ if __name__ == "__main__":
 
     runid = get_max_runID(copy_folder) + 1
 
-    for fieldname in fields:
-        if data_from_file:
-            filepath = data_folder + 'scan_data_' + id_string + fieldname + '.h5'
-            with h5py.File(filepath, mode="r") as my_file:
-                scan_list = my_file['scan_list'][()]
-                scan_data = my_file['scan_data'][()]
-        else:
-            scan_list, scan_data = get_scan_data(params, fields, fieldname)
-
-        scan_data_data_name = save_data_2_h5(params, scan_list, scan_data, fieldname, runid)
-        scan_data_data_name_list.append(scan_data_data_name)
-        print('Saved scan data')
-        accept_list, reject_reason, acc = make_accept_list(params, accept_params, scan_data)
-        print('Made accept list')
-        jk_list, cutoff_list, split_list = make_jk_list(params, accept_list, scan_list, scan_data, jk_param_list_file)
-        print('Made jk_list')
-        jk_data_name = save_jk_2_h5(params, scan_list, acc, accept_list, reject_reason, jk_list, cutoff_list, split_list, fieldname, runid)
-        jk_data_name_list.append(jk_data_name)
-
-        if show_plot:
-            labels = ['freq'] + stats_list 
-            ind = np.arange(len(acc))
-            plt.bar(ind, acc * 19, alpha=0.5, label=fieldname)
-            plt.xticks(ind, labels, rotation='vertical')
+    if not data_from_file:
+        make_ephemeris(fields)
+        # all auxiliary data is read before the pool is created, so the workers inherit it
+        get_weather_table()
+        for fieldname in fields:
+            get_sw_table(fieldname)
+
+    try:
+        for fieldname in fields:
+            if data_from_file:
+                filepath = data_folder + 'scan_data_' + id_string + fieldname + '.h5'
+                if accept_streaming:
+                    scan_list, _ = read_scan_data(filepath, [])
+                    scan_data = filepath
+                else:
+                    scan_list, scan_data = read_scan_data(filepath, stats_list)
+            else:
+                scan_list, scan_data = get_scan_data(params, fields, fieldname)
+                # the accept and jackknife lists read whole statistics, which are contiguous in the table
+                scan_data = ScanStatsTable.from_array(scan_data, stats_list)
+
+            if isinstance(scan_data, str):
+                # streamed from the scan data file, which only gets the new runID
+                scan_data_data_name = update_runid(scan_data, runid)
+            else:
+                scan_data_data_name = save_data_2_h5(params, scan_list, scan_data, fieldname, runid)
+                if accept_streaming:
+                    scan_data = scan_data_data_name
+            scan_data_data_name_list.append(scan_data_data_name)
+            print('Saved scan data')
+            accept_list, reject_reason, acc = make_accept_list(params, accept_params, scan_data)
+            print('Made accept list')
+            jk_lists = make_jk_lists(params, accept_list, scan_list, scan_data, jk_param_files, fieldname)
+            print('Made jk_list')
+            for (jk_list, cutoff_list, split_list), jk_data_string in zip(jk_lists, jk_strings):
+                jk_data_name = save_jk_2_h5(params, scan_list, acc, accept_list, reject_reason, jk_list, cutoff_list, split_list, fieldname, runid, jk_data_string, cut_list)
+                jk_data_name_list.append(jk_data_name)
+
+            if show_plot:
+                labels = ['freq'] + cut_list
+                ind = np.arange(len(acc))
+                plt.bar(ind, acc * 19, alpha=0.5, label=fieldname)
+                plt.xticks(ind, labels, rotation='vertical')
+    except BaseException:
+        close_pool(terminate=True)
+        raise
+    close_pool()
+
     if show_plot:
         plt.ylabel('effective # of feeds')
         plt.grid()
@@ -1648,18 +3197,19 @@ if __name__ == "__main__":
     param_file_copy_raw = param_file_copy_raw[-1][:-4]
     runlist_name    = params['RUNLIST']
     runlist_copy_raw    = runlist_name.split("/")[-1][:-4]
-    jk_def_raw    = jk_param_list_file.split("/")[-1][:-4]
 
     param_file_copy = copy_folder + param_file_copy_raw + f"_{runid:06d}" + ".txt"
     runlist_copy = copy_folder + runlist_copy_raw + f"_{runid:06d}" + ".txt"
-    jk_def_copy = copy_folder + jk_def_raw + f"_{runid:06d}" + ".txt"
     accept_params_name_copy = copy_folder + accept_params_name_raw + f"_{runid:06d}" + ".py"
     stats_list_name_copy = copy_folder + stats_list_name_raw + f"_{runid:06d}" + ".py"
 
 
     shutil.copyfile(param_file, param_file_copy)
     shutil.copyfile(runlist_name, runlist_copy)
-    shutil.copyfile(jk_param_list_file, jk_def_copy)
+    for jk_param_file in jk_param_files:
+        jk_def_raw = jk_param_file.split("/")[-1][:-4]
+        jk_def_copy = copy_folder + jk_def_raw + f"_{runid:06d}" + ".txt"
+        shutil.copyfile(jk_param_file, jk_def_copy)
     shutil.copyfile(accept_params_name, accept_params_name_copy)
     shutil.copyfile(stats_list_name, stats_list_name_copy)
   
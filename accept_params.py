@@ -79,3 +79,18 @@ stats_cut = {
     'sw_13': [float("nan"), float("nan")],
     'sw_14': [float("nan"), float("nan")],
 }
+
+# Virtual statistics, expressions of the statistics above (and of earlier virtual statistics) computed
+# at cut time, with feed_median and feed_mean (over the feeds of a scan and sideband) and elementwise
+# functions (abs, sqrt, exp, log, log10, sin, cos, tan, arctan2, deg2rad, floor, ceil, mod, minimum,
+# maximum, clip, where, isnan, isfinite and the constants nan, inf, pi). Only expressions within a scan
+# are supported, the scans are cut in blocks, so nothing may aggregate over scans.
+# They are cut like the statistics above when given a [min, max] in stats_cut.
+virtual_stats = {
+    # 'tsys_rel': 'tsys / feed_median(tsys)',
+}
+
+# Expression cuts, a sideband is accepted where the expression is true.
+expr_cuts = {
+    # 'ces_az_amp': '(fbit != 32) | (abs(az_amp) < 0.0003)',
+}
@@ -0,0 +1,62 @@
+from __future__ import print_function
+import sys
+import argparse
+import numpy as np
+from tqdm import tqdm
+import accept_mod
+from accept_mod import get_params, load_param_module, get_patch_info, read_scan_data, write_scan_data_stats, get_pool, close_pool, get_cached_ps_stats, ObsidData, get_obsid_filepaths, get_file_keys
+from accept_sweep import get_scan_data_filepath
+
+
+# Recomputes the ps statistics (accept_mod.ps_stats) of the saved scan_data of fields from the binned maps
+# in MAP_CACHE_DIR, written by an accept_mod run with the same MAP_CACHE_DIR, without reading the level2
+# files. Obsids without cached maps, or whose level2 files in LEVEL2_DIR changed (or are gone) since their
+# maps were cached, keep their values.
+#
+# python accept_ps.py param_file co2 co7
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Recompute the ps statistics of saved scan data from cached maps.')
+    parser.add_argument('param_file')
+    parser.add_argument('fieldnames', nargs='+')
+    args = parser.parse_args()
+
+    params = get_params(args.param_file)
+    accept_mod.stats_list = load_param_module(params, 'STATS_LIST').stats_list
+    accept_mod.patch_info = get_patch_info(params['PATCH_DEFINITION_FILE'])
+    accept_mod.map_cache_dir = params.get('MAP_CACHE_DIR', None)
+    accept_mod.ps_noise_mode = params.get('PS_NOISE_MODE', 'mc')
+    accept_mod.n_sim_ps = int(params.get('PS_N_SIM', 100))
+    accept_mod.ps_sim_seed = int(params.get('PS_SIM_SEED', 0))
+    accept_mod.n_workers = params.get('N_WORKERS', None)
+    if accept_mod.map_cache_dir is None:
+        print('No MAP_CACHE_DIR in the parameter file')
+        sys.exit(1)
+
+    try:
+        for fieldname in args.fieldnames:
+            filepath = get_scan_data_filepath(params, fieldname)
+            stats = [stat_string for stat_string in accept_mod.ps_stats if stat_string in accept_mod.stats_list]
+            scan_list, scan_data = read_scan_data(filepath, stats)
+            # the rows of an obsid are contiguous
+            offsets = list(np.flatnonzero(np.diff(scan_list // 100, prepend=-1))) + [len(scan_list)]
+            tasks = []
+            for start, stop in zip(offsets[:-1], offsets[1:]):
+                obsid_info = ObsidData()
+                obsid_info.scans = [str(scanid) for scanid in scan_list[start:stop]]
+                obsid_info.field = fieldname
+                obsid_info.l2_path = params['LEVEL2_DIR']
+                tasks.append((fieldname, obsid_info.scans, get_file_keys(get_obsid_filepaths(obsid_info))))
+            n_missing = 0
+            for (start, stop), ps in zip(zip(offsets[:-1], offsets[1:]), tqdm(get_pool().imap(get_cached_ps_stats, tasks), total=len(tasks))):
+                if ps is None:
+                    n_missing += 1
+                    continue
+                for stat_string, ps_stat in zip(accept_mod.ps_stats, ps):
+                    if stat_string in stats:
+                        scan_data[stat_string][start:stop] = ps_stat
+            write_scan_data_stats(filepath, {stat_string: scan_data[stat_string] for stat_string in stats})
+            print('Recomputed the ps statistics of %i of %i obsids of %s' % (len(tasks) - n_missing, len(tasks), fieldname))
+    finally:
+        close_pool()
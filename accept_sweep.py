@@ -0,0 +1,151 @@
+from __future__ import print_function
+import sys
+import argparse
+import h5py
+import numpy as np
+from accept_mod import get_params, load_param_module, get_rejected, AcceptCuts, ScanStatsTable, read_scan_data
+
+
+# Acceptance of the saved scan_data of a field for grids of candidate cuts, without rerunning accept_mod.
+# The cuts of accept_params are evaluated once, after which the acceptance of any grid of lower or upper
+# cuts on one or more statistics or virtual statistics, all other cuts kept, follows from a single
+# weighted histogram.
+#
+# python accept_sweep.py param_file fieldname --sweep tsys upper 40 80 41 --sweep el lower 30 40 11
+
+
+class CutSweep:
+    def __init__(self, scan_data, stats_cut, stats_list, virtual_stats=None, expr_cuts=None):
+        # scan_data is a ScanStatsTable or a scan_data array with the statistics stats_list
+        if not isinstance(scan_data, ScanStatsTable):
+            scan_data = ScanStatsTable.from_array(scan_data, stats_list)
+        n_scans, n_det, n_sb, _ = scan_data.shape
+        self.scan_data = scan_data
+        self.cuts = AcceptCuts(stats_cut, scan_data.stats, virtual_stats, expr_cuts)
+        self.norm = n_scans * 19 * 4  # as acc of make_accept_list
+        self.weights = np.nan_to_num(scan_data['acceptrate'], nan=0.0).astype(np.float64).ravel()
+
+        # number of cuts rejecting each sideband, and the first of them
+        n_cuts = len(self.cuts.names)
+        n_rejected = np.zeros((n_scans, n_det, n_sb), dtype=np.int16)
+        first_cut = np.full((n_scans, n_det, n_sb), n_cuts, dtype=np.int16)
+        for k, rejected in self.cuts.iter_rejected(scan_data):
+            n_rejected += rejected
+            np.minimum(first_cut, np.where(rejected, k, n_cuts), out=first_cut)
+        self.n_rejected = n_rejected.ravel()
+        self.first_cut = first_cut.ravel()
+
+    def get_acceptance(self):
+        # mean acceptrate left after all cuts
+        return np.sum(self.weights[self.n_rejected == 0]) / self.norm
+
+    def get_marginal_loss(self):
+        # acceptance gained by dropping each cut alone (in the order of self.cuts.names), i.e. of the
+        # sidebands rejected by that cut only
+        only = self.n_rejected == 1
+        return np.bincount(self.first_cut[only], weights=self.weights[only], minlength=len(self.cuts.names)) / self.norm
+
+    def get_values(self, stat_string):
+        # statistic or virtual statistic of all sidebands
+        return np.ravel(self.cuts.get_columns(self.scan_data)[stat_string])
+
+    def sweep(self, axes):
+        # acceptance surface of the grid of cuts axes, a list of (stat_string, side, thresholds) with side
+        # 'lower' or 'upper', replacing that cut of the statistic. Element [i0, i1, ...] of the result is
+        # the acceptance with thresholds[i0] of the first axis, thresholds[i1] of the second and so on.
+        cuts = self.cuts
+        for stat_string, _, _ in axes:
+            if stat_string not in cuts.names[:len(cuts.lower)]:
+                raise ValueError('No [min, max] cut on %s in stats_cut' % stat_string)
+        stats = [cuts.names.index(stat_string) for stat_string, _, _ in axes]
+        lower = {k: cuts.lower[k] for k in stats}
+        upper = {k: cuts.upper[k] for k in stats}
+        for (_, side, _), k in zip(axes, stats):
+            if side == 'lower':
+                lower[k] = -np.inf
+            elif side == 'upper':
+                upper[k] = np.inf
+            else:
+                raise ValueError('Unknown cut side: %s' % side)
+
+        # sidebands accepted by all other cuts, and by the cuts of the swept statistics that are kept
+        n_other = self.n_rejected.copy()
+        keep = np.ones(len(n_other), dtype=bool)
+        for k in lower:
+            values = self.get_values(cuts.names[k])
+            n_other -= get_rejected(values, cuts.lower[k], cuts.upper[k], cuts.has_cut[k])
+            keep &= ~get_rejected(values, lower[k], upper[k], True)
+        keep &= n_other == 0
+
+        # histogram of the sidebands over the first accepting threshold of every axis
+        shape = tuple(len(thresholds) for _, _, thresholds in axes)
+        bins = []
+        inverse = []
+        for (_, side, thresholds), k in zip(axes, stats):
+            thresholds = np.asarray(thresholds, dtype=np.float64)
+            order = np.argsort(thresholds, kind='stable')
+            inverse.append(np.argsort(order))
+            values = self.get_values(cuts.names[k])[keep]
+            if side == 'upper':
+                ind = np.searchsorted(thresholds[order], values, 'left')
+            else:
+                ind = np.searchsorted(thresholds[order], values, 'right') - 1
+            bins.append(ind)
+        weights = self.weights[keep]
+        valid = np.all([(ind >= 0) & (ind < n) for ind, n in zip(bins, shape)], axis=0)
+        flat = np.ravel_multi_index([ind[valid] for ind in bins], shape)
+        surface = np.bincount(flat, weights=weights[valid], minlength=int(np.prod(shape))).reshape(shape)
+
+        # a sideband is accepted by all upper thresholds above and all lower thresholds below its bin
+        for axis, (_, side, _) in enumerate(axes):
+            if side == 'upper':
+                surface = np.cumsum(surface, axis=axis)
+            else:
+                surface = np.flip(np.cumsum(np.flip(surface, axis=axis), axis=axis), axis=axis)
+        return surface[np.ix_(*inverse)] / self.norm
+
+
+def get_scan_data_filepath(params, fieldname):
+    id_string = params['ACCEPT_DATA_ID_STRING'] + '_'
+    if id_string == '_':
+        id_string = ''
+    return params['ACCEPT_DATA_FOLDER'] + 'scan_data_' + id_string + fieldname + '.h5'
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Acceptance of grids of cuts on saved scan data.')
+    parser.add_argument('param_file')
+    parser.add_argument('fieldname')
+    parser.add_argument('--sweep', nargs=5, action='append', default=[], metavar=('STAT', 'SIDE', 'START', 'STOP', 'N'),
+                        help='n thresholds from start to stop of the lower or upper cut of a statistic')
+    parser.add_argument('--output', help='h5 file for the acceptance surface')
+    args = parser.parse_args()
+
+    params = get_params(args.param_file)
+    accept_params = load_param_module(params, 'ACCEPT_MOD_PARAMS')
+    _, scan_data = read_scan_data(get_scan_data_filepath(params, args.fieldname))
+    cut_sweep = CutSweep(scan_data, accept_params.stats_cut, scan_data.stats, getattr(accept_params, 'virtual_stats', None), getattr(accept_params, 'expr_cuts', None))
+
+    print(cut_sweep.get_acceptance(), 'after all cuts')
+    marginal_loss = cut_sweep.get_marginal_loss()
+    cuts = cut_sweep.cuts
+    for i in np.argsort(marginal_loss)[::-1]:
+        if marginal_loss[i] > 0:
+            print(marginal_loss[i], cuts.names[i], cuts.descriptions[i])
+
+    if len(args.sweep) == 0:
+        sys.exit()
+    axes = [(stat_string, side, np.linspace(float(start), float(stop), int(n))) for stat_string, side, start, stop, n in args.sweep]
+    surface = cut_sweep.sweep(axes)
+    if len(axes) == 1:
+        for threshold, acc in zip(axes[0][2], surface):
+            print(threshold, acc)
+    else:
+        print(surface)
+    if args.output is not None:
+        with h5py.File(args.output, 'w') as f1:
+            f1.create_dataset('acceptance', data=surface)
+            for i, (stat_string, side, thresholds) in enumerate(axes):
+                f1.create_dataset('thresholds_%i' % i, data=thresholds)
+                f1['thresholds_%i' % i].attrs['stat'] = stat_string
+                f1['thresholds_%i' % i].attrs['side'] = side